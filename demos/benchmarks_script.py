@@ -0,0 +1,171 @@
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+from scipy.spatial import Delaunay, ConvexHull, cKDTree
+from triangulation import *
+from rupperts import *
+
+# Run from project directory with `python -m demos.benchmarks_script -all`
+
+parser = argparse.ArgumentParser(description="Benchmark script for meshing algorithms")
+parser.add_argument('-a', '--all', action='store_true', help='Run all benchmarks')
+parser.add_argument('-t', '--triangulation', action='store_true', help='Run Bowyer-Watson scaling benchmark')
+parser.add_argument('-c', '--cavity', action='store_true', help='Report Bowyer-Watson cavity size distributions')
+parser.add_argument('-o', '--order', action='store_true', help='Run Bowyer-Watson insertion order benchmark')
+parser.add_argument('-p', '--parallel', action='store_true', help='Run parallel divide-and-conquer Delaunay benchmark')
+parser.add_argument('-r', '--rupperts', action='store_true', help='Run Ruppert\'s Steiner point placement benchmark')
+parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Largest worker count for the parallel benchmark')
+parser.add_argument('-n', '--max-points', type=int, default=100000, help='Largest point count to benchmark')
+
+args = parser.parse_args()
+
+if args.all:
+    TRIANGULATION_BENCHMARK = True
+    CAVITY_BENCHMARK = True
+    ORDER_BENCHMARK = True
+    PARALLEL_BENCHMARK = True
+    RUPPERTS_BENCHMARK = True
+else:
+    TRIANGULATION_BENCHMARK = args.triangulation
+    CAVITY_BENCHMARK = args.cavity
+    ORDER_BENCHMARK = args.order
+    PARALLEL_BENCHMARK = args.parallel
+    RUPPERTS_BENCHMARK = args.rupperts
+
+# naive loop is O(n^2), only run it on small inputs
+naive_limit = 1000
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def sorted_simplices(triangles):
+    return set(tuple(sorted(triangle)) for triangle in triangles)
+
+def is_delaunay_triangulation(points, triangles):
+    # with cocircular points the Delaunay triangulation is not unique, so compare its properties instead:
+    # the triangles tile the convex hull, no edge has more than two of them and no circumcircle holds a point
+    areas = orient2d_batch(points[triangles]) / 2
+    hull_area = ConvexHull(points).volume
+    _, edge_counts = np.unique(np.sort(triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1), axis=0, return_counts=True)
+    if (areas <= 0).any() or abs(areas.sum() - hull_area) > 1e-9 * hull_area or edge_counts.max() > 2:
+        return False
+    centers, radii = calc_circumcircles(points[triangles])
+    for triangle, nearby in zip(triangles.tolist(), cKDTree(points).query_ball_point(centers, radii * (1 + 1e-9))):
+        triangle_points = points[triangle].tolist()
+        if any(j not in triangle and incircle(*triangle_points, points[j]) > 0 for j in nearby):
+            return False
+    return True
+
+######################################
+##### TRIANGULATION BENCHMARK ########
+######################################
+
+if TRIANGULATION_BENCHMARK:
+    print('\nBowyer-Watson Scaling Benchmark')
+    sizes = [n for n in [500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000] if n <= args.max_points]
+
+    print(f'{"points":>8} {"naive (s)":>10} {"walk (s)":>10} {"scipy (s)":>10} {"match":>6}')
+    for N in sizes:
+        points = np.random.rand(N, 2)
+        naive_time = '-'
+        if N <= naive_limit:
+            _, naive_time = timed(bowyer_watson, points, method='naive')
+            naive_time = f'{naive_time:.3f}'
+        tri, walk_time = timed(bowyer_watson, points, method='walk')
+        scipy_tri, scipy_time = timed(Delaunay, points)
+        match = sorted_simplices(tri.triangles) == sorted_simplices(scipy_tri.simplices)
+        print(f'{N:>8} {naive_time:>10} {walk_time:>10.3f} {scipy_time:>10.3f} {str(match):>6}')
+
+######################################
+####### CAVITY SIZE BENCHMARK ########
+######################################
+
+if CAVITY_BENCHMARK:
+    print('\nBowyer-Watson Cavity Sizes')
+    N = min(args.max_points, 20000)
+    # uniform points vs. tight gaussian clusters
+    centers = np.random.rand(20, 2)
+    datasets = {
+        'uniform': np.random.rand(N, 2),
+        'clustered': centers[np.random.randint(len(centers), size=N)] + 0.002 * np.random.randn(N, 2),
+    }
+    for name, points in datasets.items():
+        for method in ['walk', 'naive']:
+            if method == 'naive':
+                points = points[:naive_limit]
+            tri, elapsed = timed(bowyer_watson, points, method=method)
+            sizes = np.repeat(list(tri.cavity_sizes.keys()), list(tri.cavity_sizes.values()))
+            print(f'{name:>10} {method:>6} {len(points):>7} points {elapsed:8.3f}s  '
+                  f'cavity mean {sizes.mean():.2f}  p50 {np.percentile(sizes, 50):.0f}  '
+                  f'p99 {np.percentile(sizes, 99):.0f}  max {sizes.max()}')
+
+######################################
+##### INSERTION ORDER BENCHMARK ######
+######################################
+
+if ORDER_BENCHMARK:
+    print('\nBowyer-Watson Insertion Order Benchmark')
+    N = min(args.max_points, 50000)
+    unsorted_points = np.random.rand(N, 2)
+    # survey data usually arrives line by line, i.e. sorted along one axis
+    sorted_points = unsorted_points[np.lexsort((unsorted_points[:, 1], unsorted_points[:, 0]))]
+
+    print(f'{"dataset":>9} {"order":>12} {"time (s)":>9} {"speedup":>8}')
+    for name, points in [('unsorted', unsorted_points), ('sorted', sorted_points)]:
+        baseline = None
+        for order in [None, 'hilbert', 'morton', 'brio', 'brio-morton']:
+            _, elapsed = timed(bowyer_watson, points, order=order)
+            baseline = elapsed if baseline is None else baseline
+            print(f'{name:>9} {str(order or "input"):>12} {elapsed:>9.3f} {baseline / elapsed:>7.2f}x')
+
+######################################
+######## PARALLEL BENCHMARK ##########
+######################################
+
+if PARALLEL_BENCHMARK:
+    print('\nParallel Divide-and-Conquer Delaunay Benchmark')
+    N = min(args.max_points, 200000)
+    points = np.random.rand(N, 2)
+    scipy_tri, scipy_time = timed(Delaunay, points)
+    print(f'{N} points, scipy {scipy_time:.3f}s, {os.cpu_count()} cores available')
+
+    worker_counts = sorted(set([1] + [2**k for k in range(1, 10) if 2**k <= args.workers] + [args.workers]))
+    print(f'{"workers":>8} {"time (s)":>9} {"speedup":>8} {"match":>6}')
+    baseline = None
+    for workers in worker_counts:
+        triangles, elapsed = timed(parallel_delaunay, points, workers=workers)
+        baseline = elapsed if baseline is None else baseline
+        match = sorted_simplices(triangles) == sorted_simplices(scipy_tri.simplices)
+        print(f'{workers:>8} {elapsed:>9.3f} {baseline / elapsed:>7.2f}x {str(match):>6}')
+
+    # points on a grid are cocircular in every cell, the strip seams have to agree on the diagonals
+    grid_points = np.unique(np.round(points[:min(N, 20000)] * 100) / 100, axis=0)
+    print(f'{len(grid_points)} points rounded to 0.01')
+    print(f'{"workers":>8} {"time (s)":>9} {"match":>6}')
+    for workers in worker_counts:
+        triangles, elapsed = timed(parallel_delaunay, grid_points, workers=workers, strips=max(workers, 4))
+        match = is_delaunay_triangulation(grid_points, triangles)
+        print(f'{workers:>8} {elapsed:>9.3f} {str(match):>6}')
+
+######################################
+####### RUPPERTS BENCHMARK ###########
+######################################
+
+if RUPPERTS_BENCHMARK:
+    print('\nRuppert\'s Algorithm Steiner Point Benchmark')
+    inputs = {'outline-ca': read_and_process_svg('mesh_files/outline-ca.svg', epsilon=10, min_area=10000)}
+    with open('mesh_files/pslg_doubleslit.pkl', 'rb') as f:
+        inputs['doubleslit'] = pickle.load(f)
+
+    print(f'{"input":>11} {"min angle":>9} {"steiner":>12} {"vertices":>9} {"triangles":>10} {"worst":>6} {"time (s)":>9}')
+    for name, (V, S) in inputs.items():
+        for min_angle in [20, 25, 28]:
+            for steiner in ['circumcenter', 'offcenter']:
+                rupperts = Rupperts(V, S, min_angle=min_angle, steiner=steiner, max_vertices=20000)
+                triangles, elapsed = timed(rupperts.run_algo)
+                worst = mesh_quality_report(rupperts.V, triangles)['min_angle']['min']
+                print(f'{name:>11} {min_angle:>9} {steiner:>12} {len(rupperts.V):>9} {len(triangles):>10} {worst:>6.2f} {elapsed:>9.3f}')
@@ -57,6 +57,8 @@ if RUPPERTS_DEMO:
     rupperts = Rupperts(V, S, min_angle=20, max_area=float('inf'))
     triangles = rupperts.run_algo()
     print('Number of triangles:', len(triangles))
+    report = mesh_quality_report(rupperts.V, triangles)
+    print('Minimum angle: %.2f, worst radius-edge ratio: %.2f' % (report['min_angle']['min'], report['radius_edge_ratio']['max']))
 
     # PLOT RESULTS
     fig, axs = plt.subplots(1, 2, figsize=(12, 6))
@@ -1,55 +1,242 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.spatial import Voronoi, voronoi_plot_2d, Delaunay
-from utils.quadtree import *
+from scipy.spatial import Voronoi, voronoi_plot_2d, Delaunay, ConvexHull
+from scipy.optimize import minimize, Bounds
 from utils.helper import *
+from utils.density import DensityField
+from triangulation import Triangulation
 
-def lloyds_helper(points, fixed_boundary, grid_quadtree):
-    vor = Voronoi(points)
-    centroids = {}
-    for i in range(len(vor.points)):
-        seed_point = vor.points[i]
-        region = vor.regions[vor.point_region[i]]
-        polygon = [vor.vertices[j] if j >= 0 else seed_point for j in region]
-        if len(polygon) < 3:
+def voronoi_cells(points):
+    '''
+    Returns the Voronoi cells of points as a padded (N, K, 2) array (see utils/helper.py).
+    Four far away points are added around the points so that all their cells are bounded
+    '''
+    vor = Voronoi(np.vstack((points, get_far_points(points))))
+    return pad_polygons([vor.vertices[vor.regions[vor.point_region[i]]] for i in range(len(points))])
+
+def get_far_points(points):
+    center = (points.min(axis=0) + points.max(axis=0)) / 2
+    span = max(np.ptp(points, axis=0).max(), 1e-12)
+    return center + 10 * span * np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+
+def local_voronoi_cells(triangulation, indices):
+    '''
+    Returns the Voronoi cells of triangulation.points[indices] as a padded (N, K, 2) array, the
+    circumcenters of the triangles around each point in counter-clockwise order.
+    The points must not be on the hull of the triangulation
+    '''
+    stars = [[triangle_idx for triangle_idx, _ in triangulation.vertex_star(idx + triangulation.n_super)] for idx in indices]
+    triangle_ids, positions = np.unique(np.concatenate(stars), return_inverse=True)
+    centers, _ = calc_circumcircles(triangulation.points[triangulation.get_simplices(triangle_ids)])
+    return pad_polygons(np.split(centers[positions], np.cumsum([len(star) for star in stars])[:-1]))
+
+def cell_centroids(points, domain, density=None):
+    '''
+    Returns the centroids, masses (areas without a density) and energies (second moments about
+    their generator) of the Voronoi cells of points clipped to the convex domain polygon
+    (counterclockwise vertices), weighted by the DensityField density if given
+    '''
+    return polygon_centroids(clip_polygons(voronoi_cells(points), domain), points, density)
+
+def polygon_centroids(cells, generators, density=None):
+    # centroids, masses and energies of padded cells around their generators
+    if density is not None:
+        return density.cell_centroids(cells, generators)
+    centroids, areas = calc_polygon_centroids(cells)
+    return centroids, areas, calc_polygon_inertias(cells, generators)
+
+def anderson_step(X, F):
+    '''
+    Anderson acceleration of a fixed point iteration x -> x + f(x) from the histories X of
+    iterates and F of their residuals (oldest first). Returns the extrapolated next iterate
+    '''
+    x, f = X[-1], F[-1]
+    if len(X) < 2:
+        return x + f
+    dX, dF = np.diff(X, axis=0).T, np.diff(F, axis=0).T
+    gamma = np.linalg.lstsq(dF, f, rcond=None)[0]
+    return x + f - (dX + dF) @ gamma
+
+def add_stats(stats, energy, displacements, step, verbose, **extra):
+    stats.append({'iteration': len(stats), 'energy': energy, 'max_displacement': displacements.max(initial=0),
+                  'mean_displacement': displacements.mean() if len(displacements) else 0.0, 'step': step, **extra})
+    if verbose:
+        print(f"iteration {stats[-1]['iteration']}: energy {energy:.6g}, max displacement {stats[-1]['max_displacement']:.3g}, "
+              f"mean displacement {stats[-1]['mean_displacement']:.3g}" + ''.join(f', {key} {value}' for key, value in extra.items()) + f' ({step})')
+
+def converged(stats, tol, energy_tol):
+    if tol is not None and stats[-1]['max_displacement'] < tol:
+        return True
+    return energy_tol is not None and len(stats) > 1 and abs(stats[-2]['energy'] - stats[-1]['energy']) < energy_tol * stats[-1]['energy']
+
+def active_set_lloyds(points, moving, domain, density, n, tol, energy_tol, active_tol, stats, verbose):
+    '''
+    Lloyd iterations that only move the generators at least active_tol away from their centroid,
+    the others stay put until a neighbour moves. Once few generators move, the Delaunay triangulation
+    is kept up to date with Triangulation.move_points and only the cells around them are recomputed
+    '''
+    triangulation, dirty = None, None
+    for i in range(n):
+        if dirty is None:
+            centroids, masses, energies = cell_centroids(points, domain, density)
+        elif len(dirty) > 0:
+            cells = clip_polygons(local_voronoi_cells(triangulation, dirty), domain)
+            centroids[dirty], masses[dirty], energies[dirty] = polygon_centroids(cells, points[dirty], density)
+
+        displacements = np.sqrt(((centroids - points)**2).sum(axis=1))
+        active = np.flatnonzero(moving & (masses > 0) & (displacements >= active_tol))
+        add_stats(stats, energies.sum(), displacements[moving], 'lloyd', verbose, active=len(active))
+        if len(active) == 0 or converged(stats, tol, energy_tol):
+            break
+
+        # moving points one by one only pays off for a small active set, otherwise rebuild everything
+        if len(active) > len(points) // 10:
+            points[active] = centroids[active]
+            triangulation, dirty = None, None
             continue
-        
-        min_x, max_x = min([pt[0] for pt in polygon]), max([pt[0] for pt in polygon])
-        min_y, max_y = min([pt[1] for pt in polygon]), max([pt[1] for pt in polygon])
-        grid_points = grid_quadtree.query(Rectangle(min_x, min_y, max_x - min_x, max_y - min_y))
-        grid_points = [grid_point.get() for grid_point in grid_points]
-        valid_points = np.array([grid_point for grid_point in grid_points if point_in_polygon_points(grid_point, polygon)])
-
-        if len(valid_points) > 0:
-            centroid = np.mean(valid_points, axis=0)
-            if i not in fixed_boundary:
-                points[i] = centroid
+        if triangulation is None:
+            triangulation = Triangulation()
+            triangulation.insert_points(np.vstack((points, get_far_points(points))))
+        created, _ = triangulation.move_points(active, centroids[active])
+        points[active] = centroids[active]
+        # the cells that changed are the ones of the vertices of the new triangles
+        dirty = np.unique(triangulation.get_simplices(created))
+        dirty = dirty[dirty < len(points)]
+    return points
+
+class EvaluationBudgetReached(Exception):
+    # raised by lbfgs_cvt's objective once n Voronoi diagrams were built
+    pass
+
+def lbfgs_cvt(points, moving, domain, density, n, tol, energy_tol, stats, verbose):
+    '''
+    Minimizes the CVT energy over the moving points with L-BFGS-B, one Voronoi diagram per evaluation.
+    The gradient for a generator is 2 * (cell mass) * (generator - cell centroid).
+    L-BFGS-B only bounds the points to the bounding box of the domain, points outside the domain
+    are evaluated at their projection onto it, and the result is projected too.
+    maxfun is only a soft cap in L-BFGS-B (line searches can run past it), so the evaluations stop
+    explicitly after n and the lowest energy point evaluated so far is returned
+    '''
+    scale, best = [], {}
+    center = domain.mean(axis=0)
+    def project(x):
+        projected, outside, tangents = project_to_convex_polygon(x.reshape(-1, 2), domain)
+        # a hair inside the boundary so point in polygon tests agree
+        projected[outside] += 1e-9 * (center - projected[outside])
+        return projected, outside, tangents
+
+    def energy_and_gradient(x):
+        if len(stats) >= n:
+            raise EvaluationBudgetReached
+        points[moving], outside, tangents = project(x)
+        centroids, masses, energies = cell_centroids(points, domain, density)
+        residual = (centroids - points)[moving]
+        add_stats(stats, energies.sum(), np.sqrt((residual**2).sum(axis=1)), 'lbfgs', verbose)
+        # normalized by the initial energy so energy_tol is relative
+        if not scale:
+            scale.append(energies.sum() or 1.0)
+        gradient = -2 * masses[moving, np.newaxis] * residual
+        # past the boundary the projection only moves along the edge it lands on
+        gradient[outside] = (gradient[outside] * tangents[outside]).sum(axis=1, keepdims=True) * tangents[outside]
+        if not best or energies.sum() < best['energy']:
+            best.update(energy=energies.sum(), x=x.copy())
+        return energies.sum() / scale[0], gradient.ravel() / scale[0]
+
+    def stop_on_displacement(intermediate_result):
+        if tol is not None and stats[-1]['max_displacement'] < tol:
+            raise StopIteration
 
+    lo, hi = domain.min(axis=0), domain.max(axis=0)
+    n_moving = np.count_nonzero(moving)
+    x = points[moving].ravel()
+    try:
+        x = minimize(energy_and_gradient, x, jac=True, method='L-BFGS-B',
+                     bounds=Bounds(np.tile(lo, n_moving), np.tile(hi, n_moving)), callback=stop_on_displacement,
+                     options={'maxfun': n, 'maxiter': n, 'ftol': energy_tol or 0, 'gtol': 0}).x
+    except EvaluationBudgetReached:
+        x = best.get('x', x)
+    points[moving], _, _ = project(x)
     return points
 
-def lloyds(points, fixed_boundary=None, n=3):
-    N = len(points)
-    triangulation = Delaunay(points)
+def lloyds(points, fixed_boundary=None, n=3, tol=None, energy_tol=None, method='lloyd', history=5,
+           density=None, density_bounds=None, active_tol=None, verbose=False, return_stats=False):
+    '''
+    Relaxes points towards a centroidal Voronoi tessellation of their convex hull.
+
+    n - maximum number of iterations, each builds one Voronoi diagram
+    tol - stop once no point moves further than tol
+    energy_tol - stop once the CVT energy (sum of the cell second moments) drops by less than this fraction
+    method - 'lloyd' moves the points to their cell centroids, 'anderson' extrapolates from the last
+             history iterates (Anderson acceleration) and falls back to a plain Lloyd step when the
+             energy grows or a point leaves the domain, 'lbfgs' minimizes the CVT energy with L-BFGS-B
+    density - DensityField, or number, callable or (ny, nx) raster of densities over density_bounds,
+              points gather where it is high (cells get roughly equal mass instead of equal area)
+    density_bounds - (x_min, y_min, x_max, y_max) of the density raster, the bounding box of the points by default
+    active_tol - with method='lloyd', points closer than active_tol to their centroid are frozen and only
+                 the cells around moving points are recomputed, from a live Delaunay triangulation once
+                 few points move. Stats then also hold the number of active points
+    verbose - print the statistics of every iteration
+    return_stats - also return the statistics of every iteration, dicts with the energy, max and mean
+                   distance of the points to their cell centroids and the step taken
+                   ('lloyd', 'anderson', 'rejected' or 'lbfgs')
+    '''
+    if method not in ('lloyd', 'anderson', 'lbfgs'):
+        raise ValueError(f'unknown method {method}')
+    if active_tol is not None and method != 'lloyd':
+        raise ValueError('active_tol only works with method=\'lloyd\'')
+    # cells are clipped to the convex hull of the initial points
+    hull = ConvexHull(points)
+    domain = points[hull.vertices]
 
     if fixed_boundary is None:
-        fixed_boundary = list(set(triangulation.convex_hull.ravel()))
+        fixed_boundary = list(hull.vertices)
+    moving = np.ones(len(points), dtype=bool)
+    moving[fixed_boundary] = False
+    if density is not None and not isinstance(density, DensityField):
+        if density_bounds is None:
+            density_bounds = np.concatenate((domain.min(axis=0), domain.max(axis=0)))
+        density = DensityField(density, bounds=density_bounds)
 
-    boundary_points = points[fixed_boundary]
-    x_min, x_max = np.min(boundary_points[:, 0]), np.max(boundary_points[:, 0])
-    y_min, y_max = np.min(boundary_points[:, 1]), np.max(boundary_points[:, 1])
+    stats = []
+    if method == 'lbfgs':
+        points = lbfgs_cvt(points, moving, domain, density, n, tol, energy_tol, stats, verbose)
+        return (points, stats) if return_stats else points
+    if active_tol is not None:
+        points = active_set_lloyds(points, moving, domain, density, n, tol, energy_tol, active_tol, stats, verbose)
+        return (points, stats) if return_stats else points
 
-    x_grid, y_grid = np.meshgrid(np.linspace(x_min, x_max, N), np.linspace(y_min, y_max, N))
-    grid_points = np.column_stack((x_grid.ravel(), y_grid.ravel()))
-    # only keep points inside triangulation
-    grid_points = grid_points[triangulation.find_simplex(grid_points) >= 0]
+    X, F = [], []
+    last_energy, last_targets = np.inf, None
+    for i in range(n):
+        centroids, masses, energies = cell_centroids(points, domain, density)
+        targets = np.where((masses > 0)[:, np.newaxis], centroids, points)[moving]
+        residual = targets - points[moving]
+        energy = energies.sum()
+        step = method
 
-    grid_quadtree = QuadTree(Rectangle(0, 0, 1, 1))
-    for point in grid_points:
-        grid_quadtree.insert(Point(point[0], point[1]))
+        if method == 'anderson' and stats and stats[-1]['step'] == 'anderson' and energy > last_energy:
+            # the extrapolated point has a higher energy than the last iterate while a plain step never does,
+            # take the plain step instead
+            step = 'rejected'
+            points[moving] = last_targets
+            X, F = [], []
+        elif method == 'anderson':
+            X, F = (X + [points[moving].ravel()])[-history-1:], (F + [residual.ravel()])[-history-1:]
+            accelerated = anderson_step(np.array(X), np.array(F)).reshape(-1, 2)
+            if len(X) < 2 or not points_in_polygon_points(accelerated, domain).all():
+                step = 'lloyd'
+                X, F = X[-1:], F[-1:]
+                accelerated = targets
+            last_energy, last_targets = energy, targets
+            points[moving] = accelerated
+        else:
+            points[moving] = targets
 
-    for i in range(n):
-        points = lloyds_helper(points, fixed_boundary, grid_quadtree)
-    return points
+        add_stats(stats, energy, np.sqrt((residual**2).sum(axis=1)), step, verbose)
+        if step != 'rejected' and converged(stats, tol, energy_tol):
+            break
+
+    return (points, stats) if return_stats else points
 
 
 def plot_voronoi_delaunay_result(initial_vertices, final_vertices, fixed_boundary=None, boundary_edges=None, faces=None):
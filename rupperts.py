@@ -1,11 +1,21 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.spatial import Delaunay
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import pickle
+import heapq
+import os
+import json
+from multiprocessing import Pool
 from math import sqrt, acos, pi, atan2
 from utils.read_svg import *
 from utils.quadtree import *
 from utils.helper import *
+from utils.predicates import *
+from utils.pslg import PSLG
+from utils.sizing import SizingField
+from triangulation import Triangulation
 
 # TODO:
 # efficiency
@@ -17,17 +27,67 @@ from utils.helper import *
 
 # RUPPERTS ALGORITHM
 class Rupperts:
-    def __init__(self, V, S, min_angle=20, max_area=np.inf):
-        self.V = np.array(V)
-        self.S = np.array(S)
-        self.triangulation = Delaunay(V)
+    def __init__(self, V, S, min_angle=20, max_area=np.inf, priority='angle', max_vertices=None, max_triangles=None,
+                 size=None, gradation=None, steiner='circumcenter', checkpoint_path=None, checkpoint_every=1000,
+                 seed=False, min_length=None, initialize=True):
+        '''
+        priority - order in which bad triangles are fixed, 'angle' (smallest min angle first)
+                   or 'area' (largest area first)
+        max_vertices, max_triangles - refinement budget, refinement stops cleanly when reached. Unlimited by default,
+                                      refinement terminates on its own (see is_small_input_angle and min_length)
+        size - target edge length, a number, a callable on (N, 2) points or a SizingField (see utils/sizing.py),
+               triangles with an edge longer than the size at their centroid are refined
+        gradation - largest growth of size per unit distance, limits abrupt size transitions
+        steiner - point inserted to fix a bad triangle, 'circumcenter' or 'offcenter' (Ungor's off-center,
+                  on the shortest edge's bisector, which usually needs fewer Steiner points)
+        checkpoint_path - file refinement progress is saved to every checkpoint_every new vertices,
+                          when the budget is reached and when refinement finishes (see Rupperts.resume)
+        seed - bulk insert a graded point set, the leaf centres of a balanced quadtree, before quality refinement
+        min_length - segments and triangle edges shorter than this are not split further, a floor against
+                     round-off so refinement always terminates, 1e-9 times the PSLG diameter by default
+        initialize - add the bounding box, shield corners and build the mesh, False when V and S
+                     already went through this (resuming from a checkpoint)
+        '''
+        # vertices and segments, V and S are exported from it on demand
+        self.pslg = PSLG(V, S)
+        # live Delaunay mesh of V, updated locally as vertices are inserted
+        self.triangulation = None
+        # final faces, set by remove_outside when it drops the live mesh
+        self.faces = None
+        # heap of (priority, triangle id, triangle) for bad triangles, stale entries are skipped
+        self.bad_queue = []
+        # segments to check for encroachment, fed by split_seg and insert_vertex
+        self.encroach_queue = []
         self.min_angle = min_angle
         self.max_area = max_area
-        self.vertex_quadtree = None
-        self.initialize_algo()
+        self.priority = priority
+        self.max_vertices = max_vertices
+        self.max_triangles = max_triangles
+        self.size = size
+        self.gradation = gradation
+        self.steiner = steiner
+        self.seed = seed
+        self.sizing = None
+        # mesh triangle id -> size at its centroid, dropped when the triangle is destroyed
+        self.triangle_sizes = {}
+        # point-in-PSLG index over the segments, splits do not change their union so it is built once
+        self.domain_grid = None
+        # Steiner vertex on a segment -> endpoints of the input segment it lies on
+        self.segment_origins = {}
+        self.min_length = min_length
+        if min_length is None:
+            self.min_length = 1e-9 * np.ptp(self.V, axis=0).max() if len(self.V) else 0.0
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_vertices = 0
+        # 'segments' before the first fix_encroached pass, then 'triangles', 'refined' once finished
+        self.stage = 'segments'
+        if initialize:
+            self.initialize_algo()
 
     def initialize_algo(self):
         self.add_bounding_box()
+        self.initialize_sizing()
         self.corner_shielding()
         self.update_triangulation()
 
@@ -37,17 +97,24 @@ class Rupperts:
         k = 0.5
         span_x, span_y = max_x - min_x, max_y - min_y
         bbox = np.array([[min_x - k*span_x, min_y - k*span_y], [min_x - k*span_x, max_y + k*span_y], [max_x + k*span_x, max_y + k*span_y], [max_x + k*span_x, min_y - k*span_y]])
-        self.V = np.append(self.V, bbox, axis=0)
-        self.S = np.append(self.S, [[len(self.V)-4, len(self.V)-3], [len(self.V)-3, len(self.V)-2], [len(self.V)-2, len(self.V)-1], [len(self.V)-1, len(self.V)-4]], axis=0)
-        self.vertex_quadtree = QuadTree(Rectangle(bbox[0][0], bbox[0][1], bbox[2][0]-bbox[0][0], bbox[2][1]-bbox[0][1]))
+        corners = self.pslg.add_vertices(bbox)
+        for i in range(4):
+            self.pslg.add_segment(corners[i], corners[(i+1)%4])
+
+    def initialize_sizing(self):
+        if isinstance(self.size, SizingField) or self.size is None:
+            self.sizing = self.size
+        else:
+            bounds = np.concatenate((self.V.min(axis=0), self.V.max(axis=0)))
+            self.sizing = SizingField(self.size, bounds=bounds, gradation=self.gradation)
 
     def corner_shielding(self):
         # for each vertex, check if angle btw segments is too small
         # if so, calculate local feature size by finding smallest distance to other vertex
         # insert vertices to segments at lfs radius
         
-        for vert_idx, vertex in enumerate(self.V):
-            segments = self.S[np.where((self.S == vert_idx).any(axis=1))]
+        for vert_idx, vertex in enumerate(self.V.copy()):
+            segments = self.pslg.vertex_segments(vert_idx)
             if len(segments) < 2:
                 continue
             # lfs - local feature size
@@ -67,66 +134,143 @@ class Rupperts:
                     if shortest_seg is not None and np.allclose(seg, shortest_seg):
                         continue
                     seg_endpoint = self.V[seg[0]] if seg[1] == vert_idx else self.V[seg[1]]
+                    if calc_len(seg_endpoint - vertex) < 1.001 * lfs:
+                        continue # the endpoint is already on the shell, a split would duplicate it
                     new_point = vertex + lfs * (seg_endpoint - vertex) / calc_len(seg_endpoint - vertex)
                     self.split_seg(seg, new_vertex=new_point)
     
     def update_triangulation(self):
-        self.triangulation = Delaunay(self.V)
+        # full rebuild, only needed when V is modified outside of insert_vertex
+        self.triangulation = Triangulation()
+        self.triangulation.insert_points(self.V)
+
+    def insert_vertex(self, vertex, start=None):
+        '''
+        Appends vertex to V and inserts it into the live mesh, walking from triangle start if given.
+        Segments between vertices of the created triangles may have been encroached or cut,
+        they are queued for an encroachment check.
+        Returns its index and the ids of the created and destroyed triangles
+        '''
+        vert_ids, created, destroyed = self.insert_vertices([vertex], start)
+        return vert_ids[0], created, destroyed
+
+    def insert_vertices(self, vertices, start=None):
+        '''
+        Appends vertices to V and inserts them into the live mesh in one batch, new bad triangles
+        are queued. Returns their indices and the ids of the created and destroyed triangles
+        '''
+        vert_ids = self.pslg.add_vertices(vertices)
+        created, destroyed = np.empty(0, dtype=int), np.empty(0, dtype=int)
+        if self.triangulation is not None and len(vert_ids):
+            created, destroyed = self.triangulation.insert_points(vertices, start=start)
+            for triangle_idx in destroyed.tolist():
+                self.triangle_sizes.pop(triangle_idx, None)
+            self.queue_bad_triangles(created)
+            if len(vert_ids) > 1:
+                self.encroach_queue.extend(map(tuple, self.S.tolist()))
+                return vert_ids, created, destroyed
+            # the cavity boundary, any segment that was an edge of a destroyed triangle joins two of its vertices
+            cavity_vertices = sorted(set(self.triangulation.get_simplices(created).ravel().tolist()))
+            for i, a in enumerate(cavity_vertices):
+                for b in cavity_vertices[i+1:]:
+                    seg = self.pslg.get_segment(a, b)
+                    if seg is not None:
+                        self.encroach_queue.append(seg)
+        return vert_ids, created, destroyed
+
+    def get_encroached_segments(self, vertex, start=None):
+        '''
+        Returns the segments whose diametral circle contains vertex.
+
+        Only segments that are edges of the triangles vertex would destroy are tested: with all
+        segments unencroached, a vertex inside a diametral circle lies inside the circumcircle
+        of the triangle on the same side of the segment.
+        '''
+        candidates = set()
+        for triangle in self.triangulation.get_conflicts(vertex, start).tolist():
+            for i in range(3):
+                seg = self.pslg.get_segment(triangle[i-1], triangle[i])
+                if seg is not None:
+                    candidates.add(seg)
+        segments = np.array(sorted(candidates), dtype=int).reshape(-1, 2)
+        return segments[indiametral_batch(self.V[segments], vertex) < 0]
+
+    @property
+    def V(self):
+        return self.pslg.V
+
+    @property
+    def S(self):
+        return self.pslg.S
 
     def get_seg_index(self, seg):
-        try:
-            return np.where((self.S == seg).all(axis=1))[0][0]
-        except:
-            return None
+        return self.pslg.get_segment_row(seg)
 
     def get_vert_index(self, vert):
-        try:
-            return np.where((self.V == vert).all(axis=1))[0][0]
-        except:
-            return None
-
-    def fix_encroached(self, segments=None, vertices=None):
-        # Note: does not update triangulation
-        fixed = True
-        segments = self.S if segments is None else segments
-        vertices = self.V if vertices is None else vertices
-        segments_to_split = []
-        self.vertex_quadtree.clear()
-        for vertex in vertices:
-            self.vertex_quadtree.insert(Point(vertex[0], vertex[1]))
-        for seg in segments:
-            center = 0.5 * (self.V[seg[0]] + self.V[seg[1]])
-            radius = calc_len(self.V[seg[0]] - self.V[seg[1]]) / 2
-            nearby_points = self.vertex_quadtree.query(Rectangle(center[0]-radius, center[1]-radius, 2*radius, 2*radius))
-            for vertex_point in nearby_points:
-                vec = vertex_point.x - center[0], vertex_point.y - center[1]
-                if vec[0]**2 + vec[1]**2 < radius ** 2 - 1e-6: # if vertex is encroaching
-                    segments_to_split.append(seg)    # recursively check new segments
-                    fixed = False
-                    break
-
-        if not fixed:
-            for seg in segments_to_split:
-                self.split_seg(seg)
-            self.fix_encroached()
-        return fixed
+        return self.pslg.get_vertex_index(vert)
+
+    def fix_encroached(self, check_all=True):
+        '''
+        Splits segments until no vertex lies inside the diametral circle of any segment.
+
+        Works through the encroachment queue: the halves of a split segment and the segments
+        next to a new vertex are queued again. With check_all, every segment is queued first.
+        Returns False if the vertex/triangle budget was reached
+        '''
+        if check_all:
+            self.encroach_queue.extend(map(tuple, self.S.tolist()))
+        while self.encroach_queue:
+            if self.over_budget():
+                return False
+            if self.stage == 'segments':
+                self.update_checkpoint()
+            seg = self.encroach_queue.pop()
+            if self.pslg.get_segment(*seg) != seg or not self.can_split(seg) or not self.is_encroached(seg):
+                continue
+            self.split_seg(seg)
+        return True
+
+    def is_encroached(self, seg):
+        '''
+        A segment is encroached if it is missing from the Delaunay mesh, or if the opposite
+        vertex of a triangle next to it lies inside its diametral circle
+        '''
+        apexes = self.triangulation.edge_apexes(seg[0], seg[1])
+        if apexes is None:
+            return True
+        return any(indiametral(self.V[seg[0]], self.V[seg[1]], self.V[apex]) < 0 for apex in apexes)
+
+    def can_split(self, seg):
+        return calc_len(self.V[seg[0]] - self.V[seg[1]]) >= 2 * self.min_length
+
+    def get_segment_origin(self, seg):
+        # endpoints of the input segment that seg is a part of
+        for vert_idx in seg:
+            if vert_idx in self.segment_origins:
+                return self.segment_origins[vert_idx]
+        return (min(seg), max(seg))
 
     def split_seg(self, seg, new_vertex=None):
+        seg = (int(seg[0]), int(seg[1]))
         if new_vertex is None:
             new_vertex = 0.5 * (self.V[seg[0]] + self.V[seg[1]])
-        self.V = np.append(self.V, [new_vertex], axis=0)
-        new_segments = [[seg[0], len(self.V)-1], [len(self.V)-1, seg[1]]]
-        self.S = np.append(self.S, new_segments, axis=0)
-        self.S = np.delete(self.S, self.get_seg_index(seg), axis=0)
+        start = self.triangulation.vertex_triangle(seg[0]) if self.triangulation is not None else None
+        # recorded first, inserting the vertex already queues the new triangles
+        self.segment_origins[len(self.V)] = self.get_segment_origin(seg)
+        vert_idx, _, _ = self.insert_vertex(new_vertex, start)
+        new_segments = self.pslg.split_segment(seg, vert_idx)
+        self.encroach_queue.extend(new_segments)
         return new_segments
 
+    def get_simplices(self):
+        # the live mesh while refining, the final faces once remove_outside dropped it
+        return self.faces if self.triangulation is None else self.triangulation.simplices
+
     def get_min_triangle_size(self):
-        min_area = np.inf
-        for triangle in self.triangulation.simplices:
-            area = calc_area(self.V[triangle])
-            if area < min_area:
-                min_area = area
-        return min_area
+        simplices = self.get_simplices()
+        if len(simplices) == 0:
+            return np.inf
+        return calc_areas(self.V[simplices]).min()
 
     def plot(self, title=None, show=True, triangulation=True, vertices=True, highlight_vt_idx=None, highlight_seg_idx=None, ax=None):
         if ax is None:
@@ -137,7 +281,7 @@ class Rupperts:
         for seg in self.S:
             ax.plot(self.V[seg, 0], self.V[seg, 1], 'r-', linewidth=0.5)
         if triangulation:
-            ax.triplot(self.V[:, 0], self.V[:, 1], self.triangulation.simplices, linewidth=1)
+            ax.triplot(self.V[:, 0], self.V[:, 1], self.get_simplices(), linewidth=1)
         
         # for debugging
         if highlight_vt_idx is not None:
@@ -157,72 +301,478 @@ class Rupperts:
         return np.array_equal(self.V, other.V) and np.array_equal(self.S, other.S)
 
     def copy(self):
-        return Rupperts(self.V.copy(), self.S.copy(), min_angle=self.min_angle)
+        return Rupperts(self.V.copy(), self.S.copy(), min_angle=self.min_angle, max_area=self.max_area, priority=self.priority,
+                        max_vertices=self.max_vertices, max_triangles=self.max_triangles, size=self.size, gradation=self.gradation,
+                        steiner=self.steiner, seed=self.seed, min_length=self.min_length)
 
-    def fix_bad_triangles(self):
-        if len(self.V) > 2000:
-            print('too many triangles, ending recursion')
-            return
-        fixed = True
-        for triangle in self.triangulation.simplices:
-            min_angle = get_min_angle(self.V[triangle])
-            if min_angle < self.min_angle or calc_area(self.V[triangle]) > self.max_area:
-                circumcenter, radius = calc_circumcircle(self.V[triangle])
-                circumcenter_idx = len(self.V)                
-                if self.fix_encroached(vertices=[circumcenter]):
-                    self.V = np.append(self.V, [circumcenter], axis=0)
-                fixed = False
+    def is_bad_triangle(self, triangle):
+        return self.get_bad_triangles([triangle])[0]
+
+    def get_bad_triangles(self, triangles, triangle_ids=None):
+        '''
+        Returns a boolean mask of the triangles (vertex index triples) below min_angle, above max_area
+        or with an edge longer than the sizing field at their centroid.
+        With triangle_ids (their mesh ids) the sizes are cached per triangle
+        '''
+        triangles = np.asarray(triangles, dtype=int).reshape(-1, 3)
+        triangles_points = self.V[triangles]
+        skinny = calc_min_angles(triangles_points) < self.min_angle
+        # skinny triangles at a small input angle or below the round-off floor cannot be fixed, refining them never ends
+        lengths = calc_edge_lengths(triangles_points)
+        skinny &= lengths.min(axis=1) >= self.min_length
+        skinny[skinny] = [not self.is_small_input_angle(triangle, triangle_lengths)
+                          for triangle, triangle_lengths in zip(triangles[skinny].tolist(), lengths[skinny].tolist())]
+        bad = skinny | (calc_areas(triangles_points) > self.max_area)
+        if self.sizing is not None:
+            bad |= lengths.max(axis=1) > self.get_triangle_sizes(triangles_points, triangle_ids)
+        return bad
+
+    def is_small_input_angle(self, triangle, lengths):
+        '''
+        Returns True if the shortest edge of the triangle joins Steiner vertices on two input segments
+        that share an endpoint, at the same distance from it (Shewchuk's rule from Triangle).
+        The triangle is skinny because of the angle between the segments, its circumcenter would
+        encroach one of them and the splits would cascade towards their common endpoint.
+        corner_shielding and midpoint splits put those Steiner vertices on concentric shells
+        '''
+        i = int(np.argmin(lengths))
+        a, b = triangle[(i+1)%3], triangle[(i+2)%3]
+        if a not in self.segment_origins or b not in self.segment_origins:
+            return False
+        origin_a, origin_b = self.segment_origins[a], self.segment_origins[b]
+        common = set(origin_a) & set(origin_b)
+        if origin_a == origin_b or len(common) != 1:
+            return False
+        apex = self.V[common.pop()]
+        distance_a, distance_b = calc_len(self.V[a] - apex), calc_len(self.V[b] - apex)
+        return 0.999 * distance_b < distance_a < 1.001 * distance_b
+
+    def get_triangle_sizes(self, triangles_points, triangle_ids=None):
+        '''
+        Evaluates the sizing field at the centroids in one batch, reusing cached sizes of mesh triangles
+        '''
+        if triangle_ids is None:
+            return self.sizing(triangles_points.mean(axis=1))
+        triangle_ids = np.asarray(triangle_ids, dtype=int).tolist()
+        missing = [k for k, triangle_idx in enumerate(triangle_ids) if triangle_idx not in self.triangle_sizes]
+        if missing:
+            sizes = self.sizing(triangles_points[missing].mean(axis=1))
+            self.triangle_sizes.update(zip([triangle_ids[k] for k in missing], sizes.tolist()))
+        return np.array([self.triangle_sizes[triangle_idx] for triangle_idx in triangle_ids])
+
+    def queue_bad_triangles(self, triangle_ids):
+        '''
+        Pushes the bad triangles among triangle_ids onto the work queue, worst first
+        '''
+        triangle_ids = np.asarray(triangle_ids, dtype=int)
+        triangles = self.triangulation.get_simplices(triangle_ids)
+        bad = self.get_bad_triangles(triangles, triangle_ids)
+        # exterior triangles are dropped by remove_outside, refining them only costs time
+        bad[bad] = self.is_inside(self.V[triangles[bad]].mean(axis=1))
+        triangles_points = self.V[triangles[bad]]
+        keys = calc_min_angles(triangles_points) if self.priority == 'angle' else -calc_areas(triangles_points)
+        for key, triangle_idx, triangle in zip(keys.tolist(), triangle_ids[bad].tolist(), triangles[bad].tolist()):
+            heapq.heappush(self.bad_queue, (key, triangle_idx, tuple(triangle)))
+
+    def is_inside(self, points):
+        '''
+        Returns the mask of points inside the PSLG and outside its holes
+        '''
+        if self.domain_grid is None:
+            # slits, partitions and dangling segments have the same side on both sides, only outer boundaries count
+            self.domain_grid = EdgeGrid(self.V[self.S[self.pslg.enclosing_segments()]])
+        # the bounding box is a segment loop too, so inside points cross an even number of segments
+        return ~self.domain_grid.contains(points)
+
+    def get_bounding_box_segments(self):
+        '''
+        Returns the mask of the segments on the bounding box, which only bound the exterior
+        '''
+        segment_points = self.V[self.S]
+        lo, hi = self.V.min(axis=0), self.V.max(axis=0)
+        on_line = segment_points[:, 0] == segment_points[:, 1]
+        on_box = (segment_points[:, 0] == lo) | (segment_points[:, 0] == hi)
+        return (on_line & on_box).any(axis=1)
+
+    def over_budget(self):
+        return (self.max_vertices is not None and len(self.V) >= self.max_vertices) or \
+               (self.max_triangles is not None and self.triangulation.n_triangles >= self.max_triangles)
+
+    def get_seed_points(self):
+        '''
+        Returns a graded point set for bulk insertion: the leaf centres of a quadtree split around the
+        vertices (so cells follow the local feature size), split further to max_area and the sizing field,
+        and balanced so neighbouring cells differ in size by at most 2. Centres outside the PSLG, in a cell
+        with a vertex or inside the diametral circle of a segment are left out.
+        '''
+        # the tree only spans the PSLG, the ring out to the bounding box is exterior
+        on_box = ((self.V == self.V.min(axis=0)) | (self.V == self.V.max(axis=0))).any(axis=1)
+        vertices = self.V[~on_box]
+        lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+        width = (hi - lo).max()
+        spacing = self.get_seed_spacing()
+        if np.isfinite(spacing):
+            # a root of spacing times a power of 2 gives leaves of the full spacing away from the PSLG
+            width = spacing * 2**np.ceil(np.log2(width / spacing))
+        quadtree = QuadTree(Rectangle(lo[0], lo[1], width, width), capacity=1)
+        for vertex in vertices.tolist():
+            quadtree.insert(Point(vertex[0], vertex[1]))
+
+        while True:
+            leaves = quadtree.leaves()
+            widths = np.array([leaf.boundary.w for leaf in leaves])
+            centers = np.array([[leaf.boundary.x, leaf.boundary.y] for leaf in leaves]) + widths[:, np.newaxis] / 2
+            too_big = np.flatnonzero(widths > self.get_seed_spacing(centers))
+            if len(too_big) == 0:
                 break
+            for i in too_big.tolist():
+                leaves[i].subdivide()
+        quadtree.balance()
 
-        self.update_triangulation()
-        if fixed is False:
-            self.fix_bad_triangles()
+        leaves = quadtree.leaves()
+        widths = np.array([leaf.boundary.w for leaf in leaves])
+        centers = np.array([[leaf.boundary.x, leaf.boundary.y] for leaf in leaves]) + widths[:, np.newaxis] / 2
+        # the square root cell can stick out of the PSLG
+        keep = (centers < hi).all(axis=1)
+        distances, _ = cKDTree(self.V).query(centers, p=np.inf)
+        keep &= distances > widths / 2
+        segment_points = self.V[self.S]
+        midpoints = segment_points.mean(axis=1)
+        radii = np.sqrt(((segment_points[:, 0] - segment_points[:, 1])**2).sum(axis=1)) / 2
+        # seeds near the bounding box are exterior and dropped below
+        interior = ~self.get_bounding_box_segments()
+        for inside in cKDTree(centers).query_ball_point(midpoints[interior], radii[interior]):
+            keep[inside] = False
+        # seeds outside the PSLG or in its holes would be dropped by remove_outside anyway
+        keep[keep] = self.is_inside(centers[keep])
+        # leaf centres of a cell row are cocircular, a tiny jitter keeps the predicates off their exact fallback
+        jitter = np.random.default_rng(0).uniform(-1e-3, 1e-3, (len(centers), 2)) * widths[:, np.newaxis]
+        return (centers + jitter)[keep]
+
+    def get_seed_spacing(self, points=None):
+        # right triangles with legs of this length have area max_area, less a margin for the seed jitter.
+        # Without points only max_area counts, at points the sizing field too
+        spacing = 0.99 * np.sqrt(2 * self.max_area)
+        if points is None:
+            return spacing
+        spacing = np.full(len(points), spacing)
+        return spacing if self.sizing is None else np.minimum(spacing, self.sizing(points))
+
+    def seed_points(self):
+        '''
+        Splits PSLG segments longer than the seed spacing, whose diametral circles would otherwise
+        keep seeds away from them, then bulk inserts the quadtree seed points
+        '''
+        while True:
+            segment_points = self.V[self.S]
+            lengths = np.sqrt(((segment_points[:, 0] - segment_points[:, 1])**2).sum(axis=1))
+            too_long = (lengths > self.get_seed_spacing(segment_points.mean(axis=1))) & ~self.get_bounding_box_segments()
+            too_long = np.flatnonzero(too_long)
+            if len(too_long) == 0 or self.over_budget():
+                break
+            for seg in self.S[too_long].tolist():
+                self.split_seg(seg)
+        self.fix_encroached(check_all=False)
+
+        seeds = self.get_seed_points()
+        if self.max_vertices is not None:
+            seeds = seeds[:max(self.max_vertices - len(self.V), 0)]
+        if len(seeds) == 0:
+            return
+        print('inserting', len(seeds), 'seed points')
+        self.insert_vertices(seeds)
+
+    def get_steiner_point(self, triangle_points):
+        '''
+        Returns the point to insert for a bad triangle: its circumcenter, or with steiner='offcenter'
+        the point on the bisector of the shortest edge pq that sees pq under min_angle,
+        at distance (|pq|/2) / tan(min_angle/2) from its midpoint, if closer than the circumcenter
+        '''
+        circumcenter, _ = calc_circumcircle(triangle_points)
+        if self.steiner == 'circumcenter':
+            return circumcenter
+        lengths = calc_edge_lengths(triangle_points[np.newaxis])[0]
+        i = np.argmin(lengths)
+        midpoint = 0.5 * (triangle_points[(i+1)%3] + triangle_points[(i+2)%3])
+        offset = np.subtract(circumcenter, midpoint)
+        distance = calc_len(offset)
+        offcenter_distance = 0.5 * lengths[i] / np.tan(np.radians(self.min_angle) / 2)
+        if not distance > offcenter_distance:
+            return circumcenter
+        return midpoint + offset * (offcenter_distance / distance)
+
+    def fix_bad_triangles(self, rescan=True):
+        '''
+        Refines the live mesh until no triangle is below min_angle or above max_area,
+        or until the vertex/triangle budget is reached.
+
+        Bad triangles are kept in a priority queue, worst first. Only the triangles created
+        by an insertion are tested and queued, queue entries of destroyed triangles are skipped.
+        A bad triangle is fixed by inserting its circumcenter or off-center, unless that would
+        encroach a segment, in which case the encroached segments are split instead.
+        Triangles outside the PSLG are left as they are, remove_outside drops them. So are skinny
+        triangles at small input angles (see is_small_input_angle), degenerate ones and the ones
+        that could only be fixed by splitting segments below min_length, so refinement terminates.
+
+        With rescan=False the queue is taken as is instead of being rebuilt from all triangles.
+        Returns True if the mesh is fully refined
+        '''
+        if rescan:
+            self.bad_queue = []
+            self.queue_bad_triangles(self.triangulation.triangle_ids)
+        while self.bad_queue:
+            if self.over_budget():
+                return False
+            self.update_checkpoint()
+            _, triangle_idx, triangle = heapq.heappop(self.bad_queue)
+            if tuple(self.triangulation.get_simplices(triangle_idx).tolist()) != triangle:
+                continue # destroyed since it was queued
+            steiner_point = self.get_steiner_point(self.V[list(triangle)])
+            if not np.isfinite(steiner_point).all():
+                continue # degenerate triangle, no circumcenter
+            encroached = self.get_encroached_segments(steiner_point, triangle_idx).tolist()
+            splittable = [seg for seg in encroached if self.can_split(seg)]
+            if len(encroached) > 0 and len(splittable) == 0:
+                continue # only segments below min_length are encroached, leave the triangle
+            if len(splittable) > 0:
+                for seg in splittable:
+                    self.split_seg(seg)
+                done = self.fix_encroached(check_all=False)
+                # the triangle may survive the splits, revisit it
+                if tuple(self.triangulation.get_simplices(triangle_idx).tolist()) == triangle:
+                    self.queue_bad_triangles([triangle_idx])
+                if not done:
+                    return False
+            else:
+                self.insert_vertex(steiner_point, triangle_idx)
+        return True
 
     def run_algo(self):
         print('Running Ruppert\'s Algorithm')
         print('fixing encroached segments...')
-        self.fix_encroached()
-        self.update_triangulation()
+        # a resumed run continues from its saved queues
+        refined = self.fix_encroached(check_all=self.stage == 'segments')
         # self.plot(title='After fixing encroaching segments')
-        print('fixing bad triangles...')
-        self.fix_bad_triangles()
+        if refined and self.seed and self.stage == 'segments':
+            print('seeding points...')
+            self.seed_points()
+            refined = self.fix_encroached(check_all=False)
+        if refined:
+            print('fixing bad triangles...')
+            rescan = self.stage == 'segments'
+            self.stage = 'triangles'
+            refined = self.fix_bad_triangles(rescan=rescan)
+        if refined:
+            self.stage = 'refined'
+        else:
+            print('vertex/triangle budget reached, stopping refinement')
+        if self.checkpoint_path is not None:
+            self.save_checkpoint(self.checkpoint_path)
         # self.plot(title='After fixing bad triangles')
         print('removing outside triangles...')
         final_triangles = self.remove_outside()
         # self.plot(title='After removing outside')
         return final_triangles
 
+    def get_params(self):
+        size = self.size if self.size is None or np.isscalar(self.size) else 'function'
+        return {'min_angle': self.min_angle, 'max_area': self.max_area, 'priority': self.priority,
+                'max_vertices': self.max_vertices, 'max_triangles': self.max_triangles, 'size': size,
+                'gradation': self.gradation, 'steiner': self.steiner, 'seed': self.seed, 'min_length': self.min_length,
+                'checkpoint_every': self.checkpoint_every}
+
+    def update_checkpoint(self):
+        if self.checkpoint_path is not None and len(self.V) - self.checkpoint_vertices >= self.checkpoint_every:
+            self.save_checkpoint(self.checkpoint_path)
+
+    def save_checkpoint(self, path):
+        '''
+        Saves V, S, the pending queues (bad triangles as vertex triples) and the parameters
+        to a compressed .npz file, written to a temporary file first so a crash keeps the last checkpoint
+        '''
+        keys = np.array([entry[0] for entry in self.bad_queue], dtype=float)
+        queue_triangles = np.array([entry[2] for entry in self.bad_queue], dtype=np.int64).reshape(-1, 3)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, V=self.V, S=self.S, queue_keys=keys, queue_triangles=queue_triangles,
+                                encroach_queue=np.array(self.encroach_queue, dtype=np.int64).reshape(-1, 2),
+                                segment_origins=np.array([(vert_idx, *origin) for vert_idx, origin in self.segment_origins.items()], dtype=np.int64).reshape(-1, 3),
+                                stage=self.stage, params=json.dumps(self.get_params()))
+        os.replace(path + '.tmp', path)
+        self.checkpoint_vertices = len(self.V)
+        print('saved checkpoint to', path, f'({len(self.V)} vertices)')
+
+    @classmethod
+    def resume(cls, path, **overrides):
+        '''
+        Loads a checkpoint written with checkpoint_path and returns a Rupperts ready to continue
+        with run_algo(). overrides replace saved parameters, e.g. a tighter min_angle or max_area,
+        or a bigger budget. When the quality parameters change, all triangles are checked again.
+        A sizing function is not saved and has to be passed again as size.
+        '''
+        with np.load(path, allow_pickle=False) as checkpoint:
+            data = {name: checkpoint[name] for name in checkpoint.files}
+        params = json.loads(str(data['params']))
+        if params['size'] == 'function' and 'size' not in overrides:
+            raise ValueError('checkpoint was refined with a sizing function, pass it again as size')
+        quality = ['min_angle', 'max_area', 'size', 'gradation']
+        changed = any(name in overrides and overrides[name] != params[name] for name in quality)
+        params.update(overrides)
+        params.setdefault('checkpoint_path', path)
+
+        rupperts = cls(data['V'], data['S'], initialize=False, **params)
+        rupperts.initialize_sizing()
+        rupperts.update_triangulation()
+        rupperts.checkpoint_vertices = len(rupperts.V)
+        rupperts.encroach_queue = [tuple(seg) for seg in data['encroach_queue'].tolist()]
+        rupperts.segment_origins = {vert_idx: (a, b) for vert_idx, a, b in data.get('segment_origins', np.empty((0, 3), dtype=np.int64)).tolist()}
+        rupperts.stage = str(data['stage'])
+        if rupperts.stage == 'segments':
+            return rupperts
+        if changed or rupperts.stage == 'refined':
+            # a finished run has an empty queue, new parameters can make any triangle bad
+            rupperts.bad_queue = []
+            rupperts.queue_bad_triangles(rupperts.triangulation.triangle_ids)
+        else:
+            # the rebuilt mesh has new triangle ids, match queued triangles by their vertices
+            triangle_ids = rupperts.triangulation.triangle_ids.tolist()
+            simplices = rupperts.triangulation.simplices.tolist()
+            by_vertices = {tuple(sorted(triangle)): (triangle_idx, tuple(triangle)) for triangle_idx, triangle in zip(triangle_ids, simplices)}
+            for key, triangle in zip(data['queue_keys'].tolist(), data['queue_triangles'].tolist()):
+                if tuple(sorted(triangle)) in by_vertices:
+                    triangle_idx, triangle = by_vertices[tuple(sorted(triangle))]
+                    rupperts.bad_queue.append((key, triangle_idx, triangle))
+            heapq.heapify(rupperts.bad_queue)
+        rupperts.stage = 'triangles'
+        return rupperts
+
+    def classify_triangles(self):
+        '''
+        Splits the mesh into regions of triangles connected without crossing a segment, and
+        classifies every region once with is_inside at the centroid of its largest triangle,
+        so triangle queueing and the final mesh agree and interior or dangling segments do not matter.
+
+        Returns the mesh triangle ids and a boolean mask of the ones inside the PSLG
+        '''
+        triangle_ids = self.triangulation.triangle_ids
+        simplices = self.triangulation.get_simplices(triangle_ids)
+        neighbors = self.triangulation.neighbors
+        rows = np.full(self.triangulation.n_slots + 1, -1, dtype=np.int64)
+        rows[triangle_ids] = np.arange(len(triangle_ids))
+        neighbor_rows = np.where(neighbors >= 0, rows[neighbors], -1)
+
+        # edge i of a triangle is opposite its vertex i, adjacent triangles not separated by a segment are joined
+        edges = np.sort(simplices[:, [1, 2, 2, 0, 0, 1]].reshape(-1, 2), axis=1)
+        segment_keys = np.sort(self.S, axis=1) @ np.array([len(self.V), 1])
+        open_edges = (neighbor_rows.ravel() >= 0) & ~np.isin(edges @ np.array([len(self.V), 1]), segment_keys)
+        sources = np.repeat(np.arange(len(triangle_ids)), 3)[open_edges]
+        graph = coo_matrix((np.ones(len(sources)), (sources, neighbor_rows.ravel()[open_edges])),
+                           shape=(len(triangle_ids), len(triangle_ids)))
+        n_regions, regions = connected_components(graph, directed=False)
+
+        triangles_points = self.V[simplices]
+        order = np.lexsort((-calc_areas(triangles_points), regions))
+        largest = order[np.searchsorted(regions[order], np.arange(n_regions))]
+        inside = self.is_inside(triangles_points[largest].mean(axis=1))
+        return triangle_ids, inside[regions]
+
     def remove_outside(self):
-        deleted_vertices = []
-        min_x, max_x = np.min(self.V[:, 0]), np.max(self.V[:, 0])
-        min_y, max_y = np.min(self.V[:, 1]), np.max(self.V[:, 1])
-        segment_vertices = set([vert_idx for segment in self.S for vert_idx in segment])
-        for vert_idx, vertex in enumerate(self.V.copy()):
-            if vertex[0] == min_x or vertex[0] == max_x or vertex[1] == min_y or vertex[1] == max_y:
-                deleted_vertices.append(vert_idx)
-                continue
-            if vert_idx in segment_vertices:
-                continue
-            if point_in_polygon_edges(vertex, self.V[self.S]):
-                deleted_vertices.append(vert_idx)
-        
-        for vert_idx in sorted(deleted_vertices, reverse=True):
-            self.V = np.delete(self.V, vert_idx, axis=0)
-            self.S = self.S[np.where((self.S != vert_idx).all(axis=1))]
-            self.S = np.where(self.S > vert_idx, self.S - 1, self.S)
-        
-        self.update_triangulation()
+        '''
+        Drops the triangles outside the PSLG and in its holes, and the vertices
+        (bounding box and exterior Steiner points) no longer used by any triangle.
+        V and the faces are compacted with one mask, the live mesh is dropped: it would not
+        match the faces (exterior vertices gone, segments not enforced) and nothing refines it further.
 
-        segment_vertices = set([vert_idx for segment in self.S for vert_idx in segment])
-        final_triangles = []
-        for triangle in self.triangulation.simplices:
-            centroid = np.mean(self.V[triangle], axis=0)
-            if point_in_polygon_edges(centroid, self.V[self.S]):
-                final_triangles.append(triangle)
-        
-        return final_triangles
+        Returns the (N, 3) remaining faces
+        '''
+        triangle_ids, inside = self.classify_triangles()
+        faces = self.triangulation.get_simplices(triangle_ids[inside])
+        used = np.zeros(len(self.V), dtype=bool)
+        used[faces.ravel()] = True
+
+        new_idx = self.pslg.remove_vertices(np.flatnonzero(~used))
+        self.triangulation = None
+        self.triangle_sizes, self.segment_origins = {}, {}
+        self.bad_queue, self.encroach_queue = [], []
+        self.faces = new_idx[faces]
+        return self.faces
     
 
+def group_components(V, S):
+    '''
+    Splits a PSLG into independent meshing problems: its connected components, with every
+    component (or isolated vertex) nested inside another one grouped with the outermost one around it.
+    Components without a closed loop of segments (dangling polylines) enclose no area: they contain
+    no other component, and are dropped unless nested inside one that does.
+
+    Returns a list of (vertex indices, segments) per group, both indexing into V
+    '''
+    pslg = PSLG(V, S)
+    labels = pslg.connected_components()
+    n_components = labels.max() + 1
+    component_rows = [[] for _ in range(n_components)]
+    for row, label in enumerate(labels[pslg.S[:, 0]].tolist()):
+        component_rows[label].append(row)
+
+    # containers[i, j]: component i lies inside component j, tested with one vertex of i
+    grids = [EdgeGrid(pslg.V[pslg.S[rows]]) for rows in component_rows]
+    representatives = pslg.V[pslg.S[[rows[0] for rows in component_rows], 0]]
+    containers = np.array([grid.contains(representatives) for grid in grids]).T.reshape(n_components, n_components)
+    np.fill_diagonal(containers, False)
+    # a connected graph has a cycle iff it has at least as many edges as vertices
+    n_vertices = np.bincount(labels[labels >= 0], minlength=n_components)
+    encloses = np.array([len(rows) for rows in component_rows]) >= n_vertices
+    containers[:, ~encloses] = False
+    outer = np.flatnonzero(~containers.any(axis=1) & encloses)
+
+    group_of = np.where(containers.any(axis=1), -1, np.arange(n_components))
+    group_of[~containers.any(axis=1) & ~encloses] = -1
+    for i in np.flatnonzero(containers.any(axis=1)):
+        group_of[i] = outer[containers[i, outer]][0]
+    isolated = np.flatnonzero(labels < 0)
+    isolated_inside = np.array([grids[j].contains(pslg.V[isolated]) for j in outer]).reshape(len(outer), len(isolated))
+
+    groups = []
+    for k, j in enumerate(outer):
+        rows = np.concatenate([component_rows[i] for i in np.flatnonzero(group_of == j)]).astype(np.int64)
+        vertices = np.concatenate((np.unique(pslg.S[rows]), isolated[isolated_inside[k]]))
+        groups.append((vertices, pslg.S[rows]))
+    return groups
+
+def mesh_group(args):
+    V, S, kwargs = args
+    rupperts = Rupperts(V, S, **kwargs)
+    faces = rupperts.run_algo()
+    return rupperts.V.copy(), np.asarray(faces, dtype=np.int64).reshape(-1, 3), rupperts.S.copy()
+
+def mesh_components(V, S, processes=None, **kwargs):
+    '''
+    Meshes the independent parts of a PSLG (see group_components) with Ruppert's algorithm
+    in a process pool, each inside its own bounding box. kwargs are passed to Rupperts and must
+    be picklable (no lambdas as size).
+
+    Returns the merged vertices, faces and segments with global indices
+    '''
+    V = np.asarray(V, dtype=float)
+    tasks = []
+    for vertices, segments in group_components(V, S):
+        new_idx = np.full(len(V), -1, dtype=np.int64)
+        new_idx[vertices] = np.arange(len(vertices))
+        tasks.append((V[vertices], new_idx[segments], kwargs))
+
+    processes = min(processes or os.cpu_count(), len(tasks))
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.map(mesh_group, tasks)
+    else:
+        results = [mesh_group(task) for task in tasks]
+
+    offsets = np.cumsum([0] + [len(result[0]) for result in results])
+    vertices = np.concatenate([np.empty((0, 2))] + [result[0] for result in results])
+    faces = np.concatenate([np.empty((0, 3), dtype=np.int64)] + [result[1] + offset for result, offset in zip(results, offsets)])
+    segments = np.concatenate([np.empty((0, 2), dtype=np.int64)] + [result[2] + offset for result, offset in zip(results, offsets)])
+    return vertices, faces, segments
+
+
 def save_triangle_mesh(filepath, vertices, faces, boundary_edges):
     with open(filepath, 'wb') as f:
         pickle.dump([vertices, faces, boundary_edges], f)
@@ -0,0 +1,224 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from scipy.sparse import coo_matrix, diags
+from utils.helper import *
+from utils.predicates import orient2d, incircle, orient2d_batch, incircle_batch
+
+def get_edges(faces):
+    '''
+    Returns the (E, 2) sorted unique edges of the faces and how many faces share each one
+    '''
+    edges = np.sort(np.asarray(faces).reshape(-1, 3)[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    return np.unique(edges, axis=0, return_counts=True)
+
+def get_boundary_vertices(faces):
+    edges, counts = get_edges(faces)
+    return np.unique(edges[counts == 1])
+
+def laplacian_operator(n_vertices, faces):
+    '''
+    Returns the (n_vertices, n_vertices) sparse matrix averaging the mesh neighbours of every vertex
+    '''
+    edges, _ = get_edges(faces)
+    rows, cols = np.concatenate((edges[:, 0], edges[:, 1])), np.concatenate((edges[:, 1], edges[:, 0]))
+    adjacency = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_vertices, n_vertices)).tocsr()
+    degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+    return diags(1 / np.maximum(degrees, 1)) @ adjacency
+
+def incidence_operator(n_vertices, faces):
+    '''
+    Returns the (n_vertices, n_faces) sparse vertex-triangle incidence matrix
+    '''
+    faces = np.asarray(faces)
+    return coo_matrix((np.ones(faces.size), (faces.ravel(), np.repeat(np.arange(len(faces)), 3))),
+                      shape=(n_vertices, len(faces))).tocsr()
+
+def odt_targets(V, faces, incidence):
+    '''
+    Returns the optimal Delaunay triangulation update of every vertex, the area weighted mean
+    of the circumcenters of its triangles (Chen & Xu), from the incidence operator
+    '''
+    triangles_points = V[faces]
+    areas = calc_areas(triangles_points)
+    centers, _ = calc_circumcircles(triangles_points)
+    # degenerate triangles have no circumcenter and no weight
+    degenerate = ~np.isfinite(centers).all(axis=1)
+    centers[degenerate] = triangles_points[degenerate].mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (incidence @ (areas[:, np.newaxis] * centers)) / (incidence @ areas)[:, np.newaxis]
+
+def get_vertex_min_angles(V, faces):
+    '''
+    Returns the smallest angle of the triangles around every vertex, inf for vertices without triangles
+    '''
+    vertex_angles = np.full(len(V), np.inf)
+    np.minimum.at(vertex_angles, faces.ravel(), np.repeat(calc_min_angles(V[faces]), 3))
+    return vertex_angles
+
+def revert_bad_moves(old_V, new_V, faces):
+    '''
+    Moves vertices back to old_V until no triangle is inverted (or collapsed) and no moved vertex has a
+    smaller angle among its triangles than before. Every triangle touching a moved vertex is then at least
+    as good as the worst one around that vertex was, so the worst angle of the mesh never drops.
+    Returns the number of reverted vertices
+    '''
+    old_signs = np.sign(orient2d_batch(old_V[faces]))
+    old_angles = get_vertex_min_angles(old_V, faces)
+    reverted = np.zeros(len(new_V), dtype=bool)
+    while True:
+        inverted = (np.sign(orient2d_batch(new_V[faces])) != old_signs) & (old_signs != 0)
+        moved = (new_V != old_V).any(axis=1)
+        worse = moved & (get_vertex_min_angles(new_V, faces) < old_angles)
+        vertices = np.union1d(np.flatnonzero(worse), faces[inverted].ravel())
+        vertices = vertices[moved[vertices]]
+        if len(vertices) == 0:
+            return np.count_nonzero(reverted)
+        new_V[vertices] = old_V[vertices]
+        reverted[vertices] = True
+
+def lawson_flips(V, faces, fixed_edges=None, vertices=None):
+    '''
+    Flips edges whose opposite vertex lies inside the circumcircle of the other triangle until the
+    mesh is Delaunay, except fixed_edges (e.g. PSLG segments) and boundary edges.
+
+    vertices - only the edges of triangles touching these vertices (e.g. the ones that moved) can have
+               become non-Delaunay, all edges by default. The candidates are tested in one batch, only
+               the failing ones and the edges around each flip are handled one by one
+
+    Returns the counterclockwise faces and the number of flips
+    '''
+    faces = np.array(faces)
+    clockwise = orient2d_batch(V[faces]) < 0
+    faces[clockwise] = faces[clockwise][:, [0, 2, 1]]
+
+    # half-edge 3*f + i is the edge of face f opposite its vertex i, interior edges pair up two of them
+    half_edges = np.sort(faces[:, [1, 2, 2, 0, 0, 1]].reshape(-1, 2), axis=1)
+    half_keys = half_edges @ np.array([len(V), 1])
+    order = np.argsort(half_keys)
+    paired = np.flatnonzero(half_keys[order[1:]] == half_keys[order[:-1]])
+    h1, h2 = order[paired], order[paired + 1]
+    edges, keys = half_edges[h1], half_keys[h1]
+    candidates = np.ones(len(edges), dtype=bool)
+    if vertices is not None:
+        touched = np.zeros(len(V), dtype=bool)
+        touched[vertices] = True
+        touched = touched[faces].any(axis=1)
+        candidates = touched[h1 // 3] | touched[h2 // 3]
+    if fixed_edges is not None and len(fixed_edges):
+        fixed_keys = np.sort(np.asarray(fixed_edges, dtype=np.int64).reshape(-1, 2), axis=1) @ np.array([len(V), 1])
+        candidates &= ~np.isin(keys, fixed_keys)
+    candidates = np.flatnonzero(candidates)
+    failing = incircle_batch(V[faces[h1[candidates] // 3]], V[faces.ravel()[h2[candidates]]]) > 0
+    stack = [tuple(edge) for edge in edges[candidates[failing]].tolist()]
+    if not stack:
+        return faces, 0
+
+    faces = faces.tolist()
+    fixed = set() if fixed_edges is None else set(map(tuple, np.sort(np.asarray(fixed_edges).reshape(-1, 2), axis=1).tolist()))
+    # the two faces of the edges changed by flips, the others are looked up in the sorted keys
+    edge_faces = {}
+    def get_incident(edge):
+        if edge in edge_faces:
+            return edge_faces[edge]
+        j = int(np.searchsorted(keys, edge[0] * len(V) + edge[1]))
+        if j == len(keys) or keys[j] != edge[0] * len(V) + edge[1]:
+            return None # boundary edge
+        edge_faces[edge] = (int(h1[j] // 3), int(h2[j] // 3))
+        return edge_faces[edge]
+
+    n_flips = 0
+    while stack:
+        edge = stack.pop()
+        incident = get_incident(edge)
+        if edge in fixed or incident is None:
+            continue
+        f1, f2 = incident
+        # f1 as (p, q, c) counterclockwise with pq the edge, d is the apex of f2 across it
+        k = next(i for i in range(3) if faces[f1][i] not in edge)
+        p, q, c = faces[f1][(k+1)%3], faces[f1][(k+2)%3], faces[f1][k]
+        d = next(v for v in faces[f2] if v not in edge)
+        if incircle(V[p], V[q], V[c], V[d]) <= 0:
+            continue
+        # a non-convex quad p, d, q, c cannot be flipped
+        if orient2d(V[p], V[d], V[c]) <= 0 or orient2d(V[d], V[q], V[c]) <= 0:
+            continue
+
+        # qc moves from f1 to f2, pd from f2 to f1, boundary edges have no entry
+        qc, pd = (min(q, c), max(q, c)), (min(p, d), max(p, d))
+        qc_faces, pd_faces = get_incident(qc), get_incident(pd)
+        if qc_faces is not None:
+            edge_faces[qc] = tuple(f2 if f == f1 else f for f in qc_faces)
+        if pd_faces is not None:
+            edge_faces[pd] = tuple(f1 if f == f2 else f for f in pd_faces)
+        faces[f1], faces[f2] = [p, d, c], [d, q, c]
+        edge_faces[edge] = None
+        edge_faces[(min(c, d), max(c, d))] = (f1, f2)
+        stack.extend([pd, (min(d, q), max(d, q)), qc, (min(c, p), max(c, p))])
+        n_flips += 1
+    return np.array(faces, dtype=np.int64).reshape(-1, 3), n_flips
+
+def smooth(V, faces, fixed_boundary=None, n=10, method='laplacian', flip=False, segments=None, tol=None, verbose=False):
+    '''
+    Relaxes the vertices of a triangle mesh (e.g. from Rupperts.run_algo) without rebuilding it.
+    The update is built once as a sparse operator, so an iteration is a sparse multiply
+    instead of a Voronoi diagram. Moves that would invert a triangle or lower its minimum angle
+    are undone (see revert_bad_moves), so the worst angle never drops.
+
+    fixed_boundary - vertices that do not move, the mesh boundary by default
+    n - maximum number of iterations
+    method - 'laplacian' moves every vertex to the mean of its neighbours, 'odt' to the area weighted
+             mean of the circumcenters of its triangles (optimal Delaunay triangulation)
+    flip - make the mesh Delaunay again with Lawson edge flips after every iteration,
+           the operator is rebuilt when edges were flipped
+    segments - (M, 2) edges that are never flipped and whose vertices do not move, e.g. Rupperts.S
+    tol - stop once no vertex moves further than tol
+
+    Returns the smoothed vertices and the faces
+    '''
+    if method not in ('laplacian', 'odt'):
+        raise ValueError(f'unknown method {method}')
+    V = np.array(V, dtype=float)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if fixed_boundary is None:
+        fixed_boundary = get_boundary_vertices(faces)
+    # vertices without triangles have nothing to average
+    moving = np.zeros(len(V), dtype=bool)
+    moving[faces.ravel()] = True
+    moving[fixed_boundary] = False
+    if segments is not None:
+        # vertices on PSLG segments keep the constrained boundary in place
+        moving[np.asarray(segments, dtype=np.int64).ravel()] = False
+
+    operator = None
+    for i in range(n):
+        if operator is None:
+            operator = laplacian_operator(len(V), faces) if method == 'laplacian' else incidence_operator(len(V), faces)
+        targets = operator @ V if method == 'laplacian' else odt_targets(V, faces, operator)
+        new_V = V.copy()
+        new_V[moving] = targets[moving]
+        n_reverted = revert_bad_moves(V, new_V, faces)
+        displacement = np.sqrt(((new_V - V)**2).sum(axis=1)).max(initial=0)
+        moved = np.flatnonzero((new_V != V).any(axis=1))
+        V = new_V
+
+        n_flips = 0
+        if flip:
+            # after the first pass only edges around moved vertices can have stopped being Delaunay
+            faces, n_flips = lawson_flips(V, faces, segments, moved if i > 0 else None)
+            if n_flips > 0:
+                operator = None
+        if verbose:
+            print(f'iteration {i}: max displacement {displacement:.3g}, {n_reverted} reverted, {n_flips} flips')
+        if tol is not None and displacement < tol:
+            break
+    return V, faces
+
+def plot_smoothing_result(initial_vertices, initial_faces, final_vertices, final_faces, title='Mesh Smoothing'):
+    fig, axs = plt.subplots(1, 2, figsize=(12, 6))
+    fig.suptitle(f'{title}\n(Before & After)')
+    for ax, vertices, faces, name in [(axs[0], initial_vertices, initial_faces, 'Initial'), (axs[1], final_vertices, final_faces, 'Final')]:
+        ax.triplot(vertices[:, 0], vertices[:, 1], faces)
+        min_angle = calc_min_angles(vertices[faces]).min() if len(faces) else np.nan
+        ax.set_title(f'{name} Mesh (min angle {min_angle:.1f})')
+        ax.set_aspect('equal')
+    plt.show()
@@ -1,26 +1,519 @@
+import random
 import numpy as np
+from multiprocessing import Pool, shared_memory
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
+from collections import deque, Counter
 from utils.helper import *
+from utils.predicates import orient2d, incircle, indiametral
+from utils.spatial_sort import insertion_order
 
 # TODO: please refactor
 # make nice animation and plot
 
 class Triangulation:
-    def __init__(self):
-        self.points = np.empty((0, 2), dtype=float)
-        self.triangles = set()
+    def __init__(self, capacity=16):
+        # points and triangles live in preallocated buffers that double when full
+        self._points = np.empty((capacity, 2), dtype=np.float64)
+        self.n_points = 0
+        # counter-clockwise vertex ids, -1 marks a deleted slot
+        self._triangles = np.full((capacity, 3), -1, dtype=np.int32)
+        # triangle opposite vertex 0, 1, 2, -1 on the hull
+        self._neighbors = np.full((capacity, 3), -1, dtype=np.int32)
+        self.n_slots = 0
+        # live triangles that do not touch the super triangle, len(triangle_ids) without the scan
+        self.n_triangles = 0
+        self.free_slots = []
+        # slots deleted during insert_points, released to free_slots when it returns
+        self.held_slots = []
+        self.last_triangle = -1
+        # the first n_super points belong to the super triangle
+        self.n_super = 0
+        # instrumentation: number of insertions per cavity size (triangles removed)
+        self.cavity_sizes = Counter()
+        # one live triangle per point, -1 if the point is not triangulated
+        self._vertex_triangle = np.full(capacity, -1, dtype=np.int32)
+        # buffer ids of removed points, dropped from the buffer by compact_points
+        self.removed_points = set()
+
+    @property
+    def points(self):
+        # zero-copy view of the point buffer without the super triangle points
+        return self._points[self.n_super:self.n_points]
+
+    @property
+    def triangle_ids(self):
+        '''
+        Returns the ids of the live triangles that do not touch the super triangle
+        '''
+        table = self._triangles[:self.n_slots]
+        return np.flatnonzero((table >= self.n_super).all(axis=1))
+
+    @property
+    def simplices(self):
+        # copy of the live rows in the order of triangle_ids, vertex ids index into points.
+        # triangle_table is the zero-copy view of the raw table
+        return self._triangles[self.triangle_ids] - self.n_super
+
+    @property
+    def neighbors(self):
+        # copy of the triangle ids opposite each vertex of simplices, -1 on the convex hull
+        triangle_ids = self.triangle_ids
+        neighbors = self._neighbors[triangle_ids]
+        visible = np.zeros(self.n_slots + 1, dtype=bool)
+        visible[triangle_ids] = True
+        return np.where(visible[neighbors], neighbors, -1)
+
+    def get_simplices(self, triangle_ids):
+        '''
+        Returns the vertex ids (indices into points) of the given triangles,
+        rows of deleted triangles are negative
+        '''
+        return self._triangles[triangle_ids] - self.n_super
+
+    @property
+    def triangles(self):
+        return set(tuple(triangle) for triangle in self.simplices.tolist())
+
+    @property
+    def triangle_table(self):
+        # zero-copy view of the raw triangle table, including deleted (-1) and super triangle slots
+        return self._triangles[:self.n_slots]
+
+    def alive_triangles(self):
+        return np.flatnonzero(self._triangles[:self.n_slots, 0] >= 0).tolist()
 
     def add_point(self, point):
-        self.points = np.append(self.points, point[np.newaxis, :], axis=0)
-        point_idx = len(self.points) - 1
-        return point_idx
+        return self.add_points(np.asarray(point)[np.newaxis, :])[0]
 
-    def add_triangle(self, triangle):
-        self.triangles.add(triangle)
+    def add_points(self, points):
+        '''
+        Appends points to the point buffer without triangulating them.
+        Returns their buffer ids, which include the super triangle points.
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        start, end = self.n_points, self.n_points + len(points)
+        if end > len(self._points):
+            capacity = max(end, 2 * len(self._points))
+            self._points = np.concatenate((self._points[:start], np.empty((capacity - start, 2))))
+            self._vertex_triangle = np.concatenate((self._vertex_triangle[:start], np.full(capacity - start, -1, dtype=np.int32)))
+        self._points[start:end] = points
+        self.n_points = end
+        return range(start, end)
+
+    def add_triangle(self, triangle, neighbors=(-1, -1, -1)):
+        if self.free_slots:
+            triangle_idx = self.free_slots.pop()
+        else:
+            triangle_idx = self.n_slots
+            if triangle_idx == len(self._triangles):
+                grow = np.full((len(self._triangles), 3), -1, dtype=np.int32)
+                self._triangles = np.concatenate((self._triangles, grow))
+                self._neighbors = np.concatenate((self._neighbors, grow))
+            self.n_slots += 1
+        self._triangles[triangle_idx] = triangle
+        self._neighbors[triangle_idx] = neighbors
+        if min(triangle) >= self.n_super:
+            self.n_triangles += 1
+        self._vertex_triangle[list(triangle)] = triangle_idx
+        self.last_triangle = triangle_idx
+        return triangle_idx
         
-    def remove_triangle(self, triangle):
-        self.triangles.remove(triangle)
-    
+    def remove_triangle(self, triangle_idx, release=True):
+        # release=False holds the slot back so its id is not reused yet
+        if self._triangles[triangle_idx].min() >= self.n_super:
+            self.n_triangles -= 1
+        self._triangles[triangle_idx] = -1
+        self._neighbors[triangle_idx] = -1
+        (self.free_slots if release else self.held_slots).append(triangle_idx)
+        if self.last_triangle == triangle_idx:
+            self.last_triangle = -1
+
+    def compact(self):
+        '''
+        Moves live triangles to the front of the table and renumbers neighbors.
+        Triangle ids change, returns the array mapping old ids to new ids (-1 if deleted)
+        '''
+        alive = self._triangles[:self.n_slots, 0] >= 0
+        new_idx = np.full(self.n_slots + 1, -1, dtype=np.int32)  # new_idx[-1] maps hull -1 to -1
+        n_alive = np.count_nonzero(alive)
+        new_idx[:self.n_slots][alive] = np.arange(n_alive, dtype=np.int32)
+        self._triangles[:n_alive] = self._triangles[:self.n_slots][alive]
+        self._neighbors[:n_alive] = new_idx[self._neighbors[:self.n_slots][alive]]
+        self._triangles[n_alive:self.n_slots] = -1
+        self._neighbors[n_alive:self.n_slots] = -1
+        self.last_triangle = int(new_idx[self.last_triangle]) if self.last_triangle >= 0 else -1
+        self._vertex_triangle[:self.n_points] = new_idx[self._vertex_triangle[:self.n_points]]
+        self.n_slots, self.free_slots = n_alive, []
+        return new_idx[:-1]
+
+    def add_super_triangle(self, points, scale=10):
+        '''
+        Starts the triangulation with a super triangle around points. Its vertices
+        take the first buffer ids and are hidden from points and simplices.
+        '''
+        super_points, super_triangle = get_super_triangle(np.asarray(points, dtype=float).reshape(-1, 2), scale)
+        self.add_points(super_points)
+        self.n_super = 3
+        self.add_triangle(super_triangle)
+
+    def locate(self, point, start=None):
+        '''
+        Walks from start (default: last inserted triangle) towards point,
+        crossing any edge that has the point on its outer side.
+
+        Returns the index of the counter-clockwise triangle containing point
+        '''
+        triangle_idx = self.last_triangle if start is None else start
+        if triangle_idx < 0:
+            triangle_idx = self.alive_triangles()[-1]
+        while True:
+            triangle_points = self._points[self._triangles[triangle_idx]].tolist()
+            offset = random.randrange(3)
+            for k in range(3):
+                i = (offset + k) % 3
+                if orient2d(triangle_points[(i+1)%3], triangle_points[(i+2)%3], point) < 0:
+                    triangle_idx = int(self._neighbors[triangle_idx, i])
+                    if triangle_idx < 0:
+                        raise ValueError(f'point {point} is outside the triangulation')
+                    break
+            else:
+                return triangle_idx
+
+    def in_conflict(self, triangle, point):
+        '''
+        triangle: counter-clockwise vertex ids
+
+        Returns True if point lies inside the circumcircle of the triangle.
+
+        Super triangle vertices are treated as infinitely far away, so their circumcircles
+        degenerate to half-planes and the hull triangles do not depend on the super triangle size.
+        '''
+        super_idx = [i for i in range(3) if triangle[i] < self.n_super]
+        if len(super_idx) == 0:
+            return incircle(*self._points[triangle].tolist(), point) > 0
+        if len(super_idx) == 1:
+            i = super_idx[0]
+            pt1, pt2 = self._points[[triangle[(i+1)%3], triangle[(i+2)%3]]].tolist()
+            orientation = orient2d(pt1, pt2, point)
+            return orientation > 0 or (orientation == 0 and indiametral(pt1, pt2, point) < 0)
+        if len(super_idx) == 2:
+            real_idx = triangle[3 - sum(super_idx)]
+            other_super = 3 - sum(triangle[i] for i in super_idx)
+            direction = self._points[other_super] - np.mean(self._points[:3], axis=0)
+            return calc_dot(np.subtract(point, self._points[real_idx]), direction) < 0
+        return True
+
+    def find_cavity(self, point, start):
+        '''
+        Grows the cavity of triangles whose circumcircle contains point by breadth-first
+        search over neighbors, starting from the triangle containing it.
+
+        Returns the cavity triangles and its boundary edges (a, b, outer triangle,
+        slot of the outer triangle pointing back into the cavity), counter-clockwise.
+        The boundary is collected in the same pass, so the cost is linear in the cavity size.
+        '''
+        bad_triangles = {start}
+        polygon = []
+        queue = deque([start])
+        while queue:
+            triangle_idx = queue.popleft()
+            triangle = self._triangles[triangle_idx].tolist()
+            for i, neighbor in enumerate(self._neighbors[triangle_idx].tolist()):
+                if neighbor in bad_triangles:
+                    continue
+                if neighbor >= 0 and self.in_conflict(self._triangles[neighbor].tolist(), point):
+                    bad_triangles.add(neighbor)
+                    queue.append(neighbor)
+                    continue
+                outer_slot = self._neighbors[neighbor].tolist().index(triangle_idx) if neighbor >= 0 else -1
+                polygon.append((triangle[(i+1)%3], triangle[(i+2)%3], neighbor, outer_slot))
+        return bad_triangles, polygon
+
+    def insert_vertex(self, point_idx, release=True):
+        '''
+        Inserts the point with buffer id point_idx into the triangulation.
+
+        The containing triangle is found by walking, then the cavity of triangles whose
+        circumcircle contains the point is grown by breadth-first search over neighbors
+        and replaced by a fan of triangles around the point.
+
+        Returns the ids of the created and destroyed triangles that do not touch the super triangle
+        '''
+        point = tuple(self._points[point_idx].tolist())
+        start = self.locate(point)
+        if point in [tuple(pt) for pt in self._points[self._triangles[start]].tolist()]:
+            return [], [] # duplicate point, leave it unconnected
+
+        bad_triangles, polygon = self.find_cavity(point, start)
+        self.cavity_sizes[len(bad_triangles)] += 1
+        destroyed = [t for t in bad_triangles if self._triangles[t].min() >= self.n_super]
+        for triangle_idx in bad_triangles:
+            self.remove_triangle(triangle_idx, release)
+
+        # link new triangles (a, b, point) around the point through the shared endpoints
+        by_start, by_end = {}, {}
+        for a, b, outer, outer_slot in polygon:
+            new_idx = self.add_triangle((a, b, point_idx), (-1, -1, outer))
+            if outer >= 0:
+                self._neighbors[outer, outer_slot] = new_idx
+            by_start[a], by_end[b] = new_idx, new_idx
+        for a, b, outer, outer_slot in polygon:
+            new_idx = by_start[a]
+            self._neighbors[new_idx, 0], self._neighbors[new_idx, 1] = by_start[b], by_end[a]
+        created = [by_start[a] for a, b, _, _ in polygon if min(a, b) >= self.n_super]
+        return created, destroyed
+
+    def insert_points(self, points, order='brio', start=None):
+        '''
+        Inserts points into the live Delaunay triangulation, updating it in place.
+        The first call places a super triangle around its points; later points must lie inside it.
+
+        order is the insertion order (see utils/spatial_sort.py), new points always get
+        consecutive ids in points in the order they were passed. start is a triangle id near
+        the first point to start walking from (default: the last created triangle).
+
+        Returns the ids of the triangles created and destroyed by the update. A triangle
+        created and destroyed by the same call is in neither, and ids are not reused within a call.
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.n_super == 0:
+            self.add_super_triangle(points)
+        point_ids = np.asarray(self.add_points(points))
+        if start is not None and start >= 0 and self._triangles[start, 0] >= 0:
+            self.last_triangle = start
+
+        order = point_ids[insertion_order(points, order)].tolist()
+        return self._merge_updates(self.insert_vertex(point_idx, release=False) for point_idx in order)
+
+    def _merge_updates(self, updates):
+        '''
+        Runs a batch of single vertex updates, an iterable of the (created, destroyed) triangle ids
+        of insert_vertex / remove_vertex calls with release=False, then releases their held slots.
+
+        Returns the ids of the triangles created and destroyed by the whole batch. A triangle
+        created and destroyed within the batch is in neither
+        '''
+        created, destroyed = set(), set()
+        for new_triangles, old_triangles in updates:
+            for triangle_idx in old_triangles:
+                if triangle_idx in created:
+                    created.remove(triangle_idx)
+                else:
+                    destroyed.add(triangle_idx)
+            created.update(new_triangles)
+        self.free_slots.extend(self.held_slots)
+        self.held_slots = []
+        return np.array(sorted(created), dtype=np.int64), np.array(sorted(destroyed), dtype=np.int64)
+
+    def vertex_star(self, point_idx):
+        '''
+        Returns the triangles around the point with buffer id point_idx in counter-clockwise
+        order, with the position of the point in each of them
+        '''
+        start = int(self._vertex_triangle[point_idx])
+        star = []
+        triangle_idx = start
+        while True:
+            i = self._triangles[triangle_idx].tolist().index(point_idx)
+            star.append((triangle_idx, i))
+            # the next triangle counter-clockwise shares the edge from the point to vertex i+2
+            triangle_idx = int(self._neighbors[triangle_idx, (i+1)%3])
+            if triangle_idx == start or triangle_idx < 0:
+                return star
+
+    def vertex_triangle(self, idx):
+        # id of a triangle incident to points[idx], -1 if it is not connected
+        return int(self._vertex_triangle[idx + self.n_super])
+
+    def edge_apexes(self, a, b):
+        '''
+        a, b: point ids (indices into points)
+
+        Returns the ids of the opposite vertices of the triangles on both sides of edge (a, b),
+        leaving out super triangle vertices, or None if (a, b) is not an edge of the triangulation
+        '''
+        a, b = a + self.n_super, b + self.n_super
+        if self._vertex_triangle[a] < 0:
+            return None
+        apexes, found = [], False
+        for triangle_idx, i in self.vertex_star(a):
+            triangle = self._triangles[triangle_idx].tolist()
+            if b in (triangle[(i+1)%3], triangle[(i+2)%3]):
+                found = True
+                apex = triangle[(i+2)%3] if triangle[(i+1)%3] == b else triangle[(i+1)%3]
+                if apex >= self.n_super:
+                    apexes.append(apex - self.n_super)
+        return apexes if found else None
+
+    def get_conflicts(self, point, start=None):
+        '''
+        Returns the vertex ids (indices into points, super triangle vertices negative) of
+        the triangles whose circumcircle contains point, i.e. the triangles that inserting
+        it would destroy, without modifying the triangulation. start is a triangle id to walk from
+        '''
+        point = tuple(np.asarray(point, dtype=float).tolist())
+        bad_triangles, _ = self.find_cavity(point, self.locate(point, start))
+        return self._triangles[sorted(bad_triangles)] - self.n_super
+
+    def remove_vertex(self, point_idx, release=True):
+        '''
+        Removes the point with buffer id point_idx from the triangulation and fills the
+        star-shaped hole with Delaunay ears: a convex corner of the hole whose circumcircle
+        contains no other hole vertex is cut off until one triangle remains.
+
+        Returns the ids of the created and destroyed triangles that do not touch the super triangle
+        '''
+        self.removed_points.add(point_idx)
+        if self._vertex_triangle[point_idx] < 0:
+            return [], [] # point was never connected
+        star = self.vertex_star(point_idx)
+
+        # hole boundary counter-clockwise, with the triangle outside each edge
+        polygon, outer_edges = [], {}
+        for triangle_idx, i in star:
+            triangle = self._triangles[triangle_idx].tolist()
+            a, b = triangle[(i+1)%3], triangle[(i+2)%3]
+            outer = int(self._neighbors[triangle_idx, i])
+            outer_slot = self._neighbors[outer].tolist().index(triangle_idx) if outer >= 0 else -1
+            polygon.append(a)
+            outer_edges[(a, b)] = (outer, outer_slot)
+
+        destroyed = [t for t, _ in star if self._triangles[t].min() >= self.n_super]
+        for triangle_idx, _ in star:
+            self.remove_triangle(triangle_idx, release)
+        self._vertex_triangle[point_idx] = -1
+
+        new_triangles = []
+        # the hole as a circular linked list of polygon positions. Clipping an ear only changes the
+        # corners of its two neighbours, so only those are tested again: O(k^2) for a star of k triangles
+        k = len(polygon)
+        prev, next = [(j - 1) % k for j in range(k)], [(j + 1) % k for j in range(k)]
+        remaining = set(polygon)
+        corner = lambda j: [polygon[prev[j]], polygon[j], polygon[next[j]]]
+        is_ear = [self.is_delaunay_ear(corner(j), remaining) for j in range(k)]
+        ears = [j for j in range(k) if is_ear[j]]
+        j = 0
+        while len(remaining) > 3:
+            while ears and (polygon[ears[-1]] not in remaining or not is_ear[ears[-1]]):
+                ears.pop() # clipped, or no longer an ear since a neighbour was clipped
+            if not ears:
+                # an ear whose circumcircle held a clipped vertex, else only possible through round-off
+                ears = [j for j in range(k) if polygon[j] in remaining and self.is_delaunay_ear(corner(j), remaining)]
+                if not ears:
+                    ears = [j for j in range(k) if polygon[j] in remaining and orient2d(*self._points[corner(j)].tolist()) > 0]
+                for j in ears:
+                    is_ear[j] = True
+            j = ears.pop()
+            new_triangles.append(self.add_triangle(tuple(corner(j))))
+            remaining.discard(polygon[j])
+            next[prev[j]], prev[next[j]] = next[j], prev[j]
+            for neighbor in (prev[j], next[j]):
+                is_ear[neighbor] = self.is_delaunay_ear(corner(neighbor), remaining)
+                if is_ear[neighbor]:
+                    ears.append(neighbor)
+        new_triangles.append(self.add_triangle(tuple(corner(next[j]))))
+        self.link_triangles(new_triangles, outer_edges)
+
+        created = [t for t in new_triangles if self._triangles[t].min() >= self.n_super]
+        return created, destroyed
+
+    def is_delaunay_ear(self, ear, vertices):
+        # ear: counter-clockwise corner of a hole, vertices: the buffer ids of the hole boundary
+        if orient2d(*self._points[ear].tolist()) <= 0:
+            return False
+        for vertex in vertices:
+            if vertex in ear:
+                continue
+            if vertex < self.n_super and min(ear) >= self.n_super:
+                continue # super vertices are infinitely far, never inside a real circle
+            if self.in_conflict(ear, tuple(self._points[vertex].tolist())):
+                return False
+        return True
+
+    def link_triangles(self, new_triangles, outer_edges):
+        '''
+        Sets the neighbors of triangles that fill a hole.
+        outer_edges maps each counter-clockwise hole edge (a, b) to the triangle outside
+        it and the slot of that triangle pointing into the hole.
+        '''
+        owner = {}
+        for triangle_idx in new_triangles:
+            triangle = self._triangles[triangle_idx].tolist()
+            for i in range(3):
+                owner[(triangle[(i+1)%3], triangle[(i+2)%3])] = (triangle_idx, i)
+        for (a, b), (triangle_idx, i) in owner.items():
+            if (b, a) in owner:
+                self._neighbors[triangle_idx, i] = owner[(b, a)][0]
+                continue
+            outer, outer_slot = outer_edges[(a, b)]
+            self._neighbors[triangle_idx, i] = outer
+            if outer >= 0:
+                self._neighbors[outer, outer_slot] = triangle_idx
+
+    def remove_point(self, idx, compact=True):
+        '''
+        Removes points[idx] and re-triangulates only its star.
+
+        With compact=True the point buffer is compacted right away, shifting the ids of
+        later points down by one. Returns the ids of the created and destroyed triangles.
+        '''
+        return self.remove_points([idx], compact)
+
+    def remove_points(self, indices, compact=True):
+        '''
+        Removes points[indices], re-triangulating the star of each one, and compacts
+        the point ids once at the end (see compact_points).
+
+        Returns the ids of the triangles created and destroyed by the update, with
+        the same conventions as insert_points.
+        '''
+        indices = np.unique(np.asarray(indices, dtype=np.int64)).tolist()
+        created, destroyed = self._merge_updates(self.remove_vertex(idx + self.n_super, release=False) for idx in indices)
+        if compact:
+            self.compact_points()
+        return created, destroyed
+
+    def move_point(self, idx, point):
+        return self.move_points([idx], [point])
+
+    def move_points(self, indices, points):
+        '''
+        Moves points[indices] to the new (N, 2) positions keeping their ids. Each point is removed,
+        re-triangulating its star, and inserted again at its new position, so only the
+        triangles around its old and new position change.
+
+        Returns the ids of the triangles created and destroyed by the update, with
+        the same conventions as insert_points.
+        '''
+        def updates():
+            for idx, point in zip(np.asarray(indices, dtype=np.int64).tolist(), np.asarray(points, dtype=float).reshape(-1, 2)):
+                point_idx = idx + self.n_super
+                yield self.remove_vertex(point_idx, release=False)
+                self.removed_points.discard(point_idx)
+                self._points[point_idx] = point
+                yield self.insert_vertex(point_idx, release=False)
+        return self._merge_updates(updates())
+
+    def compact_points(self):
+        '''
+        Drops removed points from the buffer in one pass and renumbers the triangle table.
+        Returns the array mapping old point indices to new ones (-1 if removed)
+        '''
+        keep = np.ones(self.n_points, dtype=bool)
+        keep[list(self.removed_points)] = False
+        new_ids = np.full(self.n_points, -1, dtype=np.int32)
+        n_kept = np.count_nonzero(keep)
+        new_ids[keep] = np.arange(n_kept, dtype=np.int32)
+
+        alive = self._triangles[:self.n_slots, 0] >= 0
+        self._triangles[:self.n_slots][alive] = new_ids[self._triangles[:self.n_slots][alive]]
+        self._points[:n_kept] = self._points[:self.n_points][keep]
+        self._vertex_triangle[:n_kept] = self._vertex_triangle[:self.n_points][keep]
+        self._vertex_triangle[n_kept:self.n_points] = -1
+        self.n_points, self.removed_points = n_kept, set()
+        return new_ids[self.n_super:] - self.n_super * (new_ids[self.n_super:] >= 0)
+
     def display(self, show=True):
         plt.title('Bowyer-Watson Method for Delaunay Triangulation')
         for point in self.points:
@@ -41,57 +534,202 @@ def get_triangle_edges(triangle):
     ]
     return triangle_edges
 
-def get_super_triangle(points):
-    N = len(points)
+def get_cavity_boundary(triangles):
+    '''
+    Returns the edges that belong to exactly one of the given triangles,
+    counting edge multiplicity in a single pass
+    '''
+    edge_count = Counter(tuple(edge) for triangle in triangles for edge in get_triangle_edges(triangle))
+    return [edge for edge, count in edge_count.items() if count == 1]
+
+def get_super_triangle(points, scale=10):
+    '''
+    Returns the points of a counter-clockwise triangle containing a circle of
+    scale times the bounding box span around the points.
+    '''
     min_x, max_x = np.min(points[:, 0]), np.max(points[:, 0])
     min_y, max_y = np.min(points[:, 1]), np.max(points[:, 1])
+    center = np.array([0.5 * (min_x + max_x), 0.5 * (min_y + max_y)])
+    radius = scale * max(max_x - min_x, max_y - min_y, 1e-12)
 
-    pt1 = 0.5 * (min_x + max_x), 2*max_y - min_y
-    pt2 = 2*min_x - max_x, 2*min_y - max_y
-    pt3 = 2*max_x - min_x, 2*min_y - max_y
-
-    points = np.array([pt1, pt2, pt3])
+    angles = np.radians([90, 210, 330])
+    points = center + 2 * radius * np.column_stack((np.cos(angles), np.sin(angles)))
     triangle = (0, 1, 2)
     return points, triangle
 
-def bowyer_watson(points_list):
-    points_list = np.random.rand(30, 2)  # 30 random points in 2-D
+def bowyer_watson(points_list, method='walk', order=None):
+    '''
+    Delaunay triangulation of points_list using the Bowyer-Watson algorithm.
+
+    method='walk' keeps triangle adjacency, locates each point by walking from the
+    last inserted triangle and grows the cavity over neighbors (expected O(n log n)).
+    method='naive' tests the circumcircle of every triangle for every point (O(n^2)).
+
+    order reorders the points before insertion ('hilbert', 'morton', 'brio' or
+    'brio-morton', see utils/spatial_sort.py) so consecutive points are close together.
+    Triangles always refer to the indices of points_list.
 
+    Either way the returned triangulation stays live, more points can be added with insert_points.
+    '''
+    points_list = np.asarray(points_list, dtype=float)
     tri = Triangulation()
 
-    super_triangle = get_super_triangle(points_list)
-    for point in super_triangle[0]:
-        tri.add_point(point)
-    tri.add_triangle(super_triangle[1])
+    if method == 'walk':
+        tri.insert_points(points_list, order=order)
+        return tri
 
-    for point in points_list:
+    tri.add_super_triangle(points_list)
+    point_ids = np.asarray(tri.add_points(points_list))
+    for point_idx in point_ids[insertion_order(points_list, order)].tolist():
+        point = tri._points[point_idx]
         bad_triangles = []
-        point_idx = tri.add_point(point)
-        for triangle in tri.triangles:
-            center, radius = calc_circumcircle(tri.points[list(triangle)])
-            vec = point[0] - center[0], point[1] - center[1]
-            if calc_len(vec) < radius:
-                bad_triangles.append(triangle)
+        for triangle_idx in tri.alive_triangles():
+            if tri.in_conflict(tri._triangles[triangle_idx].tolist(), point):
+                bad_triangles.append(triangle_idx)
 
-        polygon = []
-        for triangle in bad_triangles:
-            triangle_edges = get_triangle_edges(triangle)
-            for edge in triangle_edges:
-                other_bad_edges = [edge for other_triangle in bad_triangles if other_triangle != triangle for edge in get_triangle_edges(other_triangle)]
-                if edge not in other_bad_edges: # edges
-                    polygon.append(edge)
+        tri.cavity_sizes[len(bad_triangles)] += 1
+        polygon = get_cavity_boundary(tri._triangles[bad_triangles].tolist())
 
-        for triangle in bad_triangles:
-            tri.remove_triangle(triangle)
+        for triangle_idx in bad_triangles:
+            tri.remove_triangle(triangle_idx)
 
         for edge in polygon:
+            if orient2d(tri._points[edge[0]], tri._points[edge[1]], point) < 0:
+                edge = edge[::-1]
             tri.add_triangle((edge[0], edge[1], point_idx))
 
-    for triangle in tri.triangles.copy():
-        if any([idx < 3 for idx in triangle]):
-            tri.remove_triangle(triangle)
+    # link the neighbors once at the end, walking and insert_points rely on them
+    tri.link_triangles(tri.alive_triangles(), {(i, (i+1)%3): (-1, -1) for i in range(3)})
+    return tri
 
-    tri.points = tri.points[3:]
-    tri.triangles = set([(triangle[0]-3, triangle[1]-3, triangle[2]-3) for triangle in tri.triangles])
 
-    return tri
+def triangulate_strip(args):
+    '''
+    Process pool worker: triangulates points[start:stop] of the x-sorted shared point array.
+
+    A local triangle is certified when its circumcircle lies strictly between the
+    neighboring strips (lo < x < hi) and no other strip point is on it: no other point
+    can be inside or on it, so it is in every Delaunay triangulation of all points.
+    Returns the certified triangles and the unfinished points, i.e. points on the strip
+    hull or touching a triangle that is not certified, as indices into the shared array.
+    '''
+    shm_name, n_points, start, stop, lo, hi = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        points = np.ndarray((n_points, 2), dtype=np.float64, buffer=shm.buf)[start:stop].copy()
+    finally:
+        shm.close()
+
+    tri = Triangulation()
+    tri.insert_points(points)
+    table = tri.triangle_table
+    table = table[table[:, 0] >= 0]
+    visible = (table >= tri.n_super).all(axis=1)
+
+    centers, radii = calc_circumcircles(tri._points[table[visible]])
+    # small relative margin so round-off in the circumcircle cannot certify a seam triangle
+    margin = 1e-9 * (radii + np.abs(centers[:, 0]))
+    certified = np.zeros(len(table), dtype=bool)
+    with np.errstate(invalid='ignore'):
+        certified[visible] = (centers[:, 0] - radii - margin > lo) & (centers[:, 0] + radii + margin < hi)
+    # cocircular points leave a choice of diagonals, which the seam has to make consistently
+    local_points = tri._points[tri.n_super:tri.n_points]
+    tree = cKDTree(local_points)
+    candidates = certified[visible]
+    counts = tree.query_ball_point(centers[candidates], (radii + margin)[candidates], return_length=True)
+    candidates[candidates] = counts > 3
+    nearby = tree.query_ball_point(centers[candidates], (radii + margin)[candidates])
+    for triangle_idx, ids in zip(np.flatnonzero(visible)[candidates].tolist(), nearby):
+        triangle = (table[triangle_idx] - tri.n_super).tolist()
+        triangle_points = local_points[triangle].tolist()
+        if any(j not in triangle and incircle(*triangle_points, local_points[j]) >= 0 for j in ids):
+            certified[triangle_idx] = False
+
+    unfinished = np.zeros(tri.n_points, dtype=bool)
+    unfinished[table[~certified].ravel()] = True
+    unfinished = np.flatnonzero(unfinished[tri.n_super:]) + start
+    return table[certified] - tri.n_super + start, unfinished
+
+def parallel_delaunay(points, workers=None, strips=None):
+    '''
+    Delaunay triangulation of points using a process pool.
+
+    Points are split into vertical strips of equal count, each strip is triangulated
+    by Bowyer-Watson in its own process reading from a shared-memory copy of the points,
+    and the triangles whose circumcircles stay inside their strip are kept. The seams are
+    merged by triangulating the unfinished points of all strips: the certified triangles
+    have empty circumcircles, so their edges are in this triangulation too, and its
+    triangles outside the certified ones fill the rest of the convex hull.
+
+    Returns the (M, 3) triangles as indices into points
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    N = len(points)
+    workers = workers or 1
+    strips = min(strips or workers, max(N // 3, 1))
+
+    by_x = np.argsort(points[:, 0], kind='stable')
+    sorted_points = points[by_x]
+    bounds = np.linspace(0, N, strips + 1).astype(int)
+    tasks = []
+
+    shm = shared_memory.SharedMemory(create=True, size=max(sorted_points.nbytes, 1))
+    try:
+        np.ndarray(sorted_points.shape, dtype=np.float64, buffer=shm.buf)[:] = sorted_points
+        for k in range(strips):
+            start, stop = bounds[k], bounds[k+1]
+            lo = sorted_points[start-1, 0] if k > 0 else -np.inf
+            hi = sorted_points[stop, 0] if k < strips - 1 else np.inf
+            tasks.append((shm.name, N, start, stop, lo, hi))
+        if workers > 1:
+            with Pool(workers) as pool:
+                results = pool.map(triangulate_strip, tasks)
+        else:
+            results = [triangulate_strip(task) for task in tasks]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    certified = np.concatenate([result[0] for result in results])
+    unfinished = np.unique(np.concatenate([result[1] for result in results]))
+
+    # seam triangles: Delaunay triangles of the unfinished points not covered by certified triangles
+    seam = np.empty((0, 3), dtype=np.int64)
+    if len(unfinished) >= 3:
+        seam_tri = Triangulation()
+        seam_tri.insert_points(sorted_points[unfinished])
+        seam = unfinished[seam_tri.simplices]
+        seam = seam[get_uncovered(seam, certified)]
+    return by_x[np.concatenate((certified, seam))]
+
+def get_uncovered(triangles, covering):
+    '''
+    triangles: (M, 3) counter-clockwise triangulation whose edges include the boundary edges
+    of the region covered by the (K, 3) counter-clockwise covering triangles
+
+    Returns the mask of triangles outside the covered region, found by flood filling
+    from the covered side of its boundary edges without crossing them
+    '''
+    edge_triangle = {}
+    for triangle_idx, triangle in enumerate(triangles.tolist()):
+        for i in range(3):
+            edge_triangle[(triangle[i-1], triangle[i])] = triangle_idx
+    covering_edges = set((triangle[i-1], triangle[i]) for triangle in covering.tolist() for i in range(3))
+    # a boundary edge has a covering triangle on its left only
+    boundary = [edge for edge in covering_edges if edge[::-1] not in covering_edges]
+    walls = set(boundary) | set(edge[::-1] for edge in boundary)
+
+    covered = np.zeros(len(triangles), dtype=bool)
+    stack = [edge_triangle[edge] for edge in boundary if edge in edge_triangle]
+    while stack:
+        triangle_idx = stack.pop()
+        if covered[triangle_idx]:
+            continue
+        covered[triangle_idx] = True
+        triangle = triangles[triangle_idx].tolist()
+        for i in range(3):
+            edge = (triangle[i-1], triangle[i])
+            neighbor = edge_triangle.get(edge[::-1])
+            if edge not in walls and neighbor is not None and not covered[neighbor]:
+                stack.append(neighbor)
+    return ~covered
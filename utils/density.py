@@ -0,0 +1,223 @@
+import numpy as np
+from utils.sizing import bilinear_lookup
+from utils.helper import clip_polygons
+
+# raw moments x^a y^b rho integrated over polygons, as (a, b)
+MOMENTS = ((0, 0), (1, 0), (0, 1), (2, 0), (0, 2))
+
+# DENSITY FIELDS
+# density rho(x, y) >= 0 for density weighted centroidal Voronoi tessellations. Integrals over
+# polygons become edge integrals (Green's theorem) of prefix sums along the raster rows and columns and of
+# summed-area tables, all tabulated once per raster and exact to look up anywhere, so integrating a polygon
+# costs a fixed number of lookups per edge whatever the raster resolution
+class DensityField:
+    def __init__(self, density, bounds=None, resolution=256, n_gauss=4):
+        '''
+        density - number, callable mapping (N, 2) points to (N,) densities,
+                  or (ny, nx) raster of densities at evenly spaced nodes spanning bounds
+        bounds - (x_min, y_min, x_max, y_max) covered by the raster, needed for rasters and callables.
+                 The density is bilinear between the nodes and 0 outside the bounds
+        resolution - raster nodes along the longer side when a callable is sampled
+        n_gauss - Gauss-Legendre points per polygon edge, for the part of an edge integral the tables
+                  do not give exactly (see integrate)
+        '''
+        if bounds is None:
+            raise ValueError('bounds are required for a density field')
+        self.bounds = np.asarray(bounds, dtype=float)
+        x_min, y_min, x_max, y_max = self.bounds
+        if np.isscalar(density):
+            density = lambda points, value=float(density): np.full(len(points), value)
+        if callable(density):
+            step = max(x_max - x_min, y_max - y_min) / max(resolution - 1, 1)
+            nx, ny = int(np.ceil((x_max - x_min) / step)) + 1, int(np.ceil((y_max - y_min) / step)) + 1
+            x_grid, y_grid = np.meshgrid(np.linspace(x_min, x_max, nx), np.linspace(y_min, y_max, ny))
+            self.grid = np.asarray(density(np.column_stack((x_grid.ravel(), y_grid.ravel()))), dtype=float).reshape(ny, nx)
+        else:
+            self.grid = np.asarray(density, dtype=float)
+        if (self.grid < 0).any():
+            raise ValueError('density must be non-negative')
+        if min(self.grid.shape) < 2:
+            raise ValueError('a density raster needs at least 2 x 2 nodes')
+
+        # prefix integrals of rho, x rho and x^2 rho along every raster row and of rho, y rho and y^2 rho along
+        # every column at the nodes, measured from (x_min, y_min). The density is linear between nodes, so they are exact
+        ny, nx = self.grid.shape
+        self.spacing = np.array([(x_max - x_min) / (nx - 1), (y_max - y_min) / (ny - 1)])
+        self.row_tables = line_tables(self.grid, self.spacing[0])
+        self.column_tables = line_tables(self.grid.T, self.spacing[1])
+
+        # summed-area tables of x^a y^b rho for the MOMENTS at the nodes, from the exact integrals over every raster cell
+        x_weights = node_weights(np.arange(nx - 1) * self.spacing[0], np.full(nx - 1, self.spacing[0]), self.spacing[0])
+        y_weights = node_weights(np.arange(ny - 1) * self.spacing[1], np.full(ny - 1, self.spacing[1]), self.spacing[1])
+        self.area_tables = np.zeros((len(MOMENTS), ny, nx))
+        for m, (a, b) in enumerate(MOMENTS):
+            cells = sum(y_weights[r, b][:, np.newaxis] * x_weights[c, a] * self.grid[r:ny - 1 + r, c:nx - 1 + c]
+                        for r in range(2) for c in range(2))
+            self.area_tables[m, 1:, 1:] = np.cumsum(np.cumsum(cells, axis=0), axis=1)
+
+        gauss_points, gauss_weights = np.polynomial.legendre.leggauss(n_gauss)
+        self.gauss_points, self.gauss_weights = (gauss_points + 1) / 2, gauss_weights / 2
+
+    def __call__(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        inside = ((points >= self.bounds[:2]) & (points <= self.bounds[2:])).all(axis=1)
+        return np.where(inside, bilinear_lookup(self.grid, self.bounds, points), 0.0)
+
+    def row_prefix(self, x, y):
+        '''
+        Returns the (3, N) integrals of rho, x rho and x^2 rho from x_min to x along the row through y
+        '''
+        return line_prefix(self.grid, self.row_tables, self.spacing, x, y)
+
+    def column_prefix(self, x, y):
+        '''
+        Returns the (3, N) integrals of rho, y rho and y^2 rho from y_min to y along the column through x
+        '''
+        return line_prefix(self.grid.T, self.column_tables, self.spacing[::-1], y, x)
+
+    def area_prefix(self, x, y):
+        '''
+        Returns the (len(MOMENTS), N) integrals of x^a y^b rho over [x_min, x] x [y_min, y]: the table value at the
+        node below left, the strips between the node lines and the point (prefixes along the node lines are
+        linear across them) and the bilinear corner
+        '''
+        ny, nx = self.grid.shape
+        x = np.clip(x, 0, (nx - 1) * self.spacing[0])
+        y = np.clip(y, 0, (ny - 1) * self.spacing[1])
+        i = np.minimum((x / self.spacing[0]).astype(np.int64), nx - 2)
+        j = np.minimum((y / self.spacing[1]).astype(np.int64), ny - 2)
+        x_weights = node_weights(i * self.spacing[0], x - i * self.spacing[0], self.spacing[0])
+        y_weights = node_weights(j * self.spacing[1], y - j * self.spacing[1], self.spacing[1])
+        a, b = np.array(MOMENTS).T
+        integrals = self.area_tables[:, j, i].copy()
+        for c in range(2):
+            integrals += x_weights[c, a] * self.column_tables[:, i + c, j][b]
+        for r in range(2):
+            integrals += y_weights[r, b] * self.row_tables[:, j + r, i][a]
+            for c in range(2):
+                integrals += x_weights[c, a] * y_weights[r, b] * self.grid[j + r, i + c]
+        return integrals
+
+    def integrate(self, polygons, centers):
+        '''
+        polygons: padded (N, K, 2) array (see utils/helper.py), centers: (N, 2) points
+
+        Returns the (N,) masses, (N, 2) first moments and (N,) polar second moments of the density over
+        the polygons, moments about their centers.
+
+        By Green's theorem an integral of x^a y^b rho is the contour integral of y^b P dy, P the row prefix of
+        x^a rho. Along an edge this equals the difference of the summed-area table T between its ends minus the
+        integral of x^a Q dx, Q the column prefix of y^b rho. Flat edges use the first form, steep ones the
+        second, so the raster variation the Gauss points see spans the shorter extent of the edge only.
+        The prefixes are taken relative to the ones through the center, whose share comes exactly from T
+        and leaves small integrands local to the cell. Axis-aligned edges are exact
+        '''
+        ny, nx = self.grid.shape
+        x_max, y_max = (nx - 1) * self.spacing[0], (ny - 1) * self.spacing[1]
+        polygons = np.asarray(polygons, dtype=float) - self.bounds[:2]
+        if ((polygons < 0) | (polygons > [x_max, y_max])).any():
+            # the density is 0 outside the bounds, the clipped polygons stay inside the tables
+            polygons = clip_polygons(polygons, [(0, 0), (x_max, 0), (x_max, y_max), (0, y_max)])
+        centers = np.asarray(centers, dtype=float) - self.bounds[:2]
+        following = np.roll(polygons, -1, axis=1)
+        starts, ends = polygons.reshape(-1, 2), following.reshape(-1, 2)
+        polygon_ids = np.repeat(np.arange(len(polygons)), polygons.shape[1])
+        x_c, y_c = centers[polygon_ids, 0], centers[polygon_ids, 1]
+        steps = ends - starts
+        flat = np.abs(steps[:, 1]) <= np.abs(steps[:, 0])
+        weights = self.gauss_weights * np.where(flat, steps[:, 1], steps[:, 0])[:, np.newaxis]
+        # Gauss points along every edge, (E, G)
+        x = starts[:, 0, np.newaxis] + self.gauss_points * steps[:, 0, np.newaxis]
+        y = starts[:, 1, np.newaxis] + self.gauss_points * steps[:, 1, np.newaxis]
+
+        # T at the vertices (an edge's end is the next edge's start), and at the feet of the center lines:
+        # (x_c, y) at both ends of flat edges, (x, y_c) at both ends of steep ones
+        corners = np.concatenate((starts, np.where(flat[:, np.newaxis], np.column_stack((x_c, starts[:, 1])), np.column_stack((starts[:, 0], y_c))),
+                                  np.where(flat[:, np.newaxis], np.column_stack((x_c, ends[:, 1])), np.column_stack((ends[:, 0], y_c)))))
+        T = self.area_prefix(corners[:, 0], corners[:, 1]).reshape(len(MOMENTS), 3, len(starts))
+        next_edges = np.arange(len(starts)).reshape(polygons.shape[:2])
+        T_ends = T[:, 0, np.roll(next_edges, -1, axis=1).ravel()]
+        center_lines = T[:, 2] - T[:, 1]
+
+        integrals = np.zeros((len(MOMENTS), len(starts)))
+        e = np.flatnonzero(flat)
+        if len(e):
+            xe, ye, G = x[e].ravel(), y[e].ravel(), x.shape[1]
+            P = self.row_prefix(np.concatenate((xe, np.repeat(x_c[e], G))), np.concatenate((ye, ye)))
+            P = (P[:, :len(xe)] - P[:, len(xe):]).reshape(3, len(e), G)
+            for m, (a, b) in enumerate(MOMENTS):
+                integrals[m, e] = (y[e]**b * P[a] * weights[e]).sum(axis=1) + center_lines[m, e]
+        e = np.flatnonzero(~flat)
+        if len(e):
+            xe, ye, G = x[e].ravel(), y[e].ravel(), x.shape[1]
+            Q = self.column_prefix(np.concatenate((xe, xe)), np.concatenate((ye, np.repeat(y_c[e], G))))
+            Q = (Q[:, :len(xe)] - Q[:, len(xe):]).reshape(3, len(e), G)
+            for m, (a, b) in enumerate(MOMENTS):
+                integrals[m, e] = T_ends[m, e] - T[m, 0, e] - (x[e]**a * Q[b] * weights[e]).sum(axis=1) - center_lines[m, e]
+
+        M00, M10, M01, M20, M02 = [np.bincount(polygon_ids, integral, minlength=len(polygons)) for integral in integrals]
+        x_c, y_c = centers[:, 0], centers[:, 1]
+        masses = M00
+        moments = np.column_stack((M10 - x_c*M00, M01 - y_c*M00))
+        inertias = M20 - 2*x_c*M10 + x_c**2*M00 + M02 - 2*y_c*M01 + y_c**2*M00
+        # clockwise polygons integrate to negative values
+        cross = polygons[..., 0]*following[..., 1] - following[..., 0]*polygons[..., 1]
+        signs = np.where(cross.sum(axis=1) < 0, -1.0, 1.0)
+        return signs * masses, signs[:, np.newaxis] * moments, signs * inertias
+
+    def cell_centroids(self, polygons, centers):
+        '''
+        Returns the (N, 2) density weighted centroids, (N,) masses and (N,) energies (second moments of
+        the density about the (N, 2) centers) of the padded polygons, empty polygons are centred on their center
+        '''
+        centers = np.asarray(centers, dtype=float)
+        masses, moments, inertias = self.integrate(polygons, centers)
+        masses = np.maximum(masses, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offsets = np.where((masses > 0)[:, np.newaxis], moments / masses[:, np.newaxis], 0)
+        return centers + offsets, masses, np.maximum(inertias, 0)
+
+def line_tables(grid, spacing):
+    '''
+    Returns the (3, rows, columns) prefix integrals of rho, u rho and u^2 rho along the rows of grid at its
+    nodes, u measured from the first node
+    '''
+    node_u = np.arange(grid.shape[1] - 1) * spacing
+    slopes = np.diff(grid, axis=1) / spacing
+    steps = cell_integrals(node_u, grid[:, :-1], slopes, spacing)
+    return np.concatenate((np.zeros((3, grid.shape[0], 1)), np.cumsum(steps, axis=2)), axis=2)
+
+def line_prefix(grid, tables, spacing, u, v):
+    '''
+    Returns the (3, N) prefix integrals (see line_tables) along the rows of grid up to u, at v across them.
+    spacing holds the node spacing along and across the rows. The density is linear in v between rows,
+    so are its prefix integrals
+    '''
+    n_rows, n_columns = grid.shape
+    u = np.clip(u, 0, (n_columns - 1) * spacing[0])
+    v = np.clip(v / spacing[1], 0, n_rows - 1)
+    i = np.minimum((u / spacing[0]).astype(np.int64), n_columns - 2)
+    j = np.minimum(v.astype(np.int64), n_rows - 2)
+    t = v - j
+    integrals = []
+    for row in (j, j + 1):
+        slopes = (grid[row, i + 1] - grid[row, i]) / spacing[0]
+        integrals.append(tables[:, row, i] + cell_integrals(i * spacing[0], grid[row, i], slopes, u - i * spacing[0]))
+    return (1 - t) * integrals[0] + t * integrals[1]
+
+def node_weights(u0, delta, spacing):
+    '''
+    Returns the (2, 3, ...) integrals of (1 - s) u^p and s u^p over [u0, u0 + delta] for p = 0, 1, 2, with
+    s = (u - u0) / spacing the position in a raster cell starting at node u0: the weights of its two nodes
+    '''
+    return np.stack((cell_integrals(u0, 1.0, -1 / spacing, delta), cell_integrals(u0, 0.0, 1 / spacing, delta)))
+
+def cell_integrals(x0, rho0, slope, delta):
+    '''
+    Returns the (3, ...) integrals of rho, x rho and x^2 rho over [x0, x0 + delta]
+    for the linear density rho(x) = rho0 + slope * (x - x0)
+    '''
+    d1, d2, d3, d4 = delta, delta**2 / 2, delta**3 / 3, delta**4 / 4
+    return np.stack((rho0*d1 + slope*d2,
+                     x0*rho0*d1 + (x0*slope + rho0)*d2 + slope*d3,
+                     x0**2*rho0*d1 + (x0**2*slope + 2*x0*rho0)*d2 + (2*x0*slope + rho0)*d3 + slope*d4))
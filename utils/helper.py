@@ -1,4 +1,6 @@
+import numpy as np
 from math import sqrt, pi, cos, acos
+from utils.predicates import orient2d
 
 # useful functions used across all files
 
@@ -7,30 +9,42 @@ def calc_circumcircle(triangle_points):
     triangle_points: list of 3 points in the form [x, y]
 
     Returns the center and radius of the circumcircle of the triangle
+    (infinite for a degenerate triangle)
     '''
-    vecs = [triangle_points[i] - triangle_points[(i+1)%3] for i in range(3)]
-    mids = [0.5 * (triangle_points[i] + triangle_points[(i+1)%3]) for i in range(3)]
-    perps = [[vec[1], -vec[0]] for vec in vecs]
+    ax, ay = triangle_points[0][0], triangle_points[0][1]
+    bx, by = triangle_points[1][0] - ax, triangle_points[1][1] - ay
+    cx, cy = triangle_points[2][0] - ax, triangle_points[2][1] - ay
 
-    # remove bisectors with 0 slope
-    for i in range(3):
-        if perps[i][0] == 0:
-            perps.pop(i)
-            mids.pop(i)
-            break
-
-    # calculate center using intersection of bisectors
-    s1, s2 = [perp[1] / perp[0] for perp in perps[:2]]
-    m1, m2 = mids[:2]
-    x = (m2[1] - m1[1] + m1[0]*s1 - m2[0]*s2) / (s1 - s2)
-    y = m1[1] + s1*(x - m1[0])
-    center = [x, y]
+    # solve for the center relative to the first point, no bisector slopes involved
+    d = 2 * orient2d(triangle_points[0], triangle_points[1], triangle_points[2])
+    if d == 0:
+        return [np.inf, np.inf], np.inf
+    b_len2, c_len2 = bx*bx + by*by, cx*cx + cy*cy
+    ux = (cy * b_len2 - by * c_len2) / d
+    uy = (bx * c_len2 - cx * b_len2) / d
+    center = [ax + ux, ay + uy]
+    radius = sqrt(ux*ux + uy*uy)
 
-    a, b, c = [calc_len(vec) for vec in vecs]
-    radius = a*b*c / sqrt((a+b+c)*(b+c-a)*(c+a-b)*(a+b-c))
-    
     return center, radius
 
+def calc_circumcircles(triangles_points):
+    '''
+    triangles_points: (N, 3, 2) array of triangle points
+
+    Returns the (N, 2) circumcenters and (N,) circumradii of all triangles
+    (infinite for degenerate triangles)
+    '''
+    triangles_points = np.asarray(triangles_points, dtype=float)
+    a = triangles_points[:, 0]
+    b = triangles_points[:, 1] - a
+    c = triangles_points[:, 2] - a
+    d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+    b_len2, c_len2 = (b**2).sum(axis=1), (c**2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = np.column_stack((c[:, 1] * b_len2 - b[:, 1] * c_len2, b[:, 0] * c_len2 - c[:, 0] * b_len2)) / d[:, np.newaxis]
+    u[d == 0] = np.inf
+    return a + u, np.sqrt((u**2).sum(axis=1))
+
 def calc_len(vec):
     return (vec[0]**2 + vec[1]**2)**0.5
 
@@ -54,6 +68,114 @@ def get_min_angle(triangle):
         angle = acos(abs(calc_dot(sides[0], sides[1]) / (lengths[0] * lengths[1])))
     return angle * 180 / pi
 
+# BATCH TRIANGLE QUALITY
+# all take an (N, 3, 2) array of triangle points, degenerate triangles give 0 angles and infinite ratios
+
+def calc_edge_lengths(triangles_points):
+    '''
+    Returns the (N, 3) edge lengths, edge i is opposite to vertex i
+    '''
+    triangles_points = np.asarray(triangles_points, dtype=float)
+    edges = np.roll(triangles_points, -1, axis=1) - np.roll(triangles_points, 1, axis=1)
+    return np.sqrt((edges**2).sum(axis=2))
+
+def calc_areas(triangles_points):
+    triangles_points = np.asarray(triangles_points, dtype=float)
+    vec1 = triangles_points[:, 1] - triangles_points[:, 0]
+    vec2 = triangles_points[:, 2] - triangles_points[:, 0]
+    return np.abs(vec1[:, 0]*vec2[:, 1] - vec1[:, 1]*vec2[:, 0]) / 2
+
+def calc_min_angles(triangles_points):
+    '''
+    Returns the (N,) smallest angle of every triangle in degrees
+    '''
+    triangles_points = np.asarray(triangles_points, dtype=float)
+    vec1 = np.roll(triangles_points, -1, axis=1) - triangles_points
+    vec2 = np.roll(triangles_points, 1, axis=1) - triangles_points
+    cross = np.abs(vec1[..., 0]*vec2[..., 1] - vec1[..., 1]*vec2[..., 0])
+    dot = (vec1 * vec2).sum(axis=2)
+    # atan2 stays accurate for needle triangles, where acos of the cosine does not
+    return np.degrees(np.arctan2(cross, dot).min(axis=1))
+
+def calc_radius_edge_ratios(triangles_points):
+    '''
+    Returns the (N,) circumradius to shortest edge ratios, 1/sqrt(3) for an equilateral triangle
+    '''
+    lengths = calc_edge_lengths(triangles_points)
+    areas = calc_areas(triangles_points)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = lengths.prod(axis=1) / (4 * areas * lengths.min(axis=1))
+    ratios[areas == 0] = np.inf
+    return ratios
+
+def calc_aspect_ratios(triangles_points):
+    '''
+    Returns the (N,) circumradius to twice the inradius ratios, 1 for an equilateral triangle
+    '''
+    lengths = calc_edge_lengths(triangles_points)
+    areas = calc_areas(triangles_points)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # R = abc / 4A, r = 2A / (a+b+c)
+        ratios = lengths.prod(axis=1) * lengths.sum(axis=1) / (16 * areas**2)
+    ratios[areas == 0] = np.inf
+    return ratios
+
+def quality_histogram(values, bins=10, value_range=None, log=False, clip=99):
+    '''
+    Returns the histogram counts and bin edges of values over value_range, and how many values fall
+    outside it (non-finite ones included). Without a range the bins span the values up to the clip
+    percentile, so a heavy tail does not squeeze the bulk into the first bin. With log the bins are
+    log-spaced over the positive values
+    '''
+    values = np.asarray(values, dtype=float)
+    finite = values[np.isfinite(values)]
+    if value_range is None:
+        usable = finite[finite > 0] if log else finite
+        value_range = (usable.min(), np.percentile(usable, clip)) if len(usable) else (1.0, 2.0)
+    low, high = np.log10(value_range) if log else value_range
+    # values equal up to round-off (e.g. a regular grid) get a widened range, histogram needs finite-sized bins
+    pad = (max(abs(low), abs(high)) or 1.0) * 1e-9
+    if high - low <= pad:
+        low, high = low - pad, high + pad
+    edges = np.logspace(low, high, bins + 1) if log else np.linspace(low, high, bins + 1)
+    if log:
+        # exact ends, so the extreme values are not lost to round-off
+        edges[[0, -1]] = np.minimum(edges[0], value_range[0]), np.maximum(edges[-1], value_range[1])
+    counts, _ = np.histogram(finite, bins=edges)
+    return counts, edges, len(values) - counts.sum()
+
+def mesh_quality_report(V, faces, bins=10, n_worst=10):
+    '''
+    V: (M, 2) vertices, faces: (N, 3) vertex indices
+
+    Returns a dict with an entry per quality measure ('min_angle', 'area', 'radius_edge_ratio',
+    'aspect_ratio') holding its min, max, mean, histogram (counts, bin edges), the number of values
+    outside the histogram and the face indices of the n_worst worst triangles, worst first (smallest
+    min angle, largest area and ratios). Min angles are binned over [0, 60] degrees, the heavy-tailed
+    areas and ratios in log-spaced bins up to their 99th percentile (see quality_histogram)
+    '''
+    faces = np.asarray(faces, dtype=int).reshape(-1, 3)
+    triangles_points = np.asarray(V, dtype=float)[faces]
+    measures = {'min_angle': calc_min_angles(triangles_points),
+                'area': calc_areas(triangles_points),
+                'radius_edge_ratio': calc_radius_edge_ratios(triangles_points),
+                'aspect_ratio': calc_aspect_ratios(triangles_points)}
+    report = {'n_triangles': len(faces)}
+    for name, values in measures.items():
+        finite = values[np.isfinite(values)]
+        if name == 'min_angle':
+            counts, edges, outside = quality_histogram(values, bins, value_range=(0, 60))
+        else:
+            counts, edges, outside = quality_histogram(values, bins, log=True)
+        order = np.argsort(values if name == 'min_angle' else -values, kind='stable')
+        report[name] = {'min': values.min() if len(values) else np.nan,
+                        'max': values.max() if len(values) else np.nan,
+                        'mean': finite.mean() if len(finite) else np.nan,
+                        'histogram': (counts, edges),
+                        'outside': outside,
+                        'worst': order[:n_worst]}
+    return report
+
 def intersect(pt1, pt2, pt3, pt4):
     x1, y1 = pt1
     x2, y2 = pt2
@@ -68,28 +190,194 @@ def intersect(pt1, pt2, pt3, pt4):
     return 0 <= t <= 1 and 0 <= u <= 1
 
 def point_in_polygon_points(point, polygon_points):
-    count = 0
-    polygon_edges = [(polygon_points[i], polygon_points[(i+1)%len(polygon_points)]) for i in range(len(polygon_points))]
-    max_x = max([abs(edge[0][0]) for edge in polygon_edges])
-    max_y = max([abs(edge[0][1]) for edge in polygon_edges])
-    far_point = (2*max_x, 2*max_y)
-    for edge in polygon_edges:
-        point = (point[0], point[1])
-        edge1_pt = (edge[0][0], edge[0][1])
-        edge2_pt = (edge[1][0], edge[1][1])
-        if intersect(point, far_point, edge1_pt, edge2_pt):
-            count += 1
-    return count % 2 == 1
+    return points_in_polygon_points([point], polygon_points)[0]
 
 def point_in_polygon_edges(point, polygon_edges):
-    count = 0
-    max_x = max([abs(edge[0][0]) for edge in polygon_edges])
-    max_y = max([abs(edge[0][1]) for edge in polygon_edges])
-    far_point = (2*max_x, 2*max_y)
-    for edge in polygon_edges:
-        point = (point[0], point[1])
-        edge1_pt = (edge[0][0], edge[0][1])
-        edge2_pt = (edge[1][0], edge[1][1])
-        if intersect(point, far_point, edge1_pt, edge2_pt):
-            count += 1
-    return count % 2 == 1
\ No newline at end of file
+    return points_in_polygon_edges([point], polygon_edges)[0]
+
+def points_in_polygon_points(points, polygon_points):
+    '''
+    points: (N, 2) query points, polygon_points: polygon vertices in order
+
+    Returns the (N,) boolean mask of the points inside the polygon
+    '''
+    polygon_points = np.asarray(polygon_points, dtype=float).reshape(-1, 2)
+    return EdgeGrid(np.stack((polygon_points, np.roll(polygon_points, -1, axis=0)), axis=1)).contains(points)
+
+def points_in_polygon_edges(points, polygon_edges):
+    '''
+    points: (N, 2) query points, polygon_edges: (E, 2, 2) edge soup, e.g. V[S]
+
+    Returns the (N,) boolean mask of the points inside (even-odd rule)
+    '''
+    return EdgeGrid(polygon_edges).contains(points)
+
+
+class EdgeGrid:
+    '''
+    Horizontal slab index over an edge soup for repeated point-in-polygon queries.
+
+    Each edge is stored in every row its y-range overlaps, so the crossing count of a
+    ray towards +x only needs the edges of the query point's row. Build once per boundary
+    and reuse it for all query batches.
+    '''
+    def __init__(self, edges, n_rows=None):
+        self.edges = np.asarray(edges, dtype=float).reshape(-1, 2, 2)
+        edge_y = self.edges[:, :, 1]
+        self.n_rows = n_rows or max(1, int(sqrt(len(self.edges))))
+        self.y_min, self.y_max = (edge_y.min(), edge_y.max()) if len(self.edges) else (0.0, -1.0)
+        self.row_height = (self.y_max - self.y_min) / self.n_rows or 1.0
+
+        # bucket edge ids by row, as one flat array with row offsets
+        first, last = self.get_rows(edge_y.min(axis=1)), self.get_rows(edge_y.max(axis=1))
+        counts = last - first + 1
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.repeat(first, counts) + offsets
+        order = np.argsort(rows, kind='stable')
+        self.row_edges = np.repeat(np.arange(len(self.edges)), counts)[order]
+        self.row_starts = np.searchsorted(rows[order], np.arange(self.n_rows + 1))
+
+    def get_rows(self, y):
+        return np.clip(((np.asarray(y) - self.y_min) / self.row_height).astype(np.int64), 0, self.n_rows - 1)
+
+    def contains(self, points, chunk_size=2**20):
+        '''
+        points: (N, 2) query points
+
+        Returns the (N,) boolean mask of the points inside (odd number of crossings)
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        inside = np.zeros(len(points), dtype=bool)
+        candidates = np.flatnonzero((points[:, 1] >= self.y_min) & (points[:, 1] <= self.y_max))
+        rows = self.get_rows(points[candidates, 1])
+        order = np.argsort(rows, kind='stable')
+        candidates, rows = candidates[order], rows[order]
+        bounds = np.searchsorted(rows, np.arange(self.n_rows + 1))
+
+        for row in range(self.n_rows):
+            edges = self.edges[self.row_edges[self.row_starts[row]:self.row_starts[row+1]]]
+            row_points = candidates[bounds[row]:bounds[row+1]]
+            if len(edges) == 0 or len(row_points) == 0:
+                continue
+            # keep the (points x edges) crossing matrix bounded
+            step = max(1, chunk_size // len(edges))
+            for start in range(0, len(row_points), step):
+                idx = row_points[start:start+step]
+                inside[idx] = count_crossings(points[idx], edges) % 2 == 1
+        return inside
+
+
+def count_crossings(points, edges):
+    '''
+    Returns the number of edges crossed by the ray from each point towards +x.
+    Half-open in y, so a ray through a shared vertex counts once
+    '''
+    x1, y1, x2, y2 = edges[:, 0, 0], edges[:, 0, 1], edges[:, 1, 0], edges[:, 1, 1]
+    px, py = points[:, 0:1], points[:, 1:2]
+    straddles = (y1 > py) != (y2 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+    return np.count_nonzero(straddles & (x_cross > px), axis=1)
+
+
+# BATCH POLYGONS
+# (N, K, 2) arrays of polygons, shorter polygons padded by repeating their last vertex
+# (zero length edges leave areas, centroids and clipping unchanged)
+
+def pad_polygons(polygons):
+    '''
+    Stacks a list of polygons (each (k, 2), k >= 1) into an (N, K, 2) padded array
+    '''
+    counts = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+    K = max(counts.max(), 1) if len(polygons) else 1
+    flat = np.concatenate([np.asarray(polygon, dtype=float).reshape(-1, 2) for polygon in polygons]) if len(polygons) else np.empty((0, 2))
+    starts = np.cumsum(counts) - counts
+    # slot k of polygon i takes its vertex min(k, count-1)
+    rows = starts[:, np.newaxis] + np.minimum(np.arange(K), counts[:, np.newaxis] - 1)
+    return flat[rows]
+
+def clip_polygons(polygons, clip_polygon):
+    '''
+    Sutherland-Hodgman clipping of every polygon in the padded (N, K, 2) array against the
+    convex clip_polygon (counterclockwise vertices), one clip edge at a time for all polygons.
+
+    Returns the padded clipped polygons, polygons entirely outside collapse to a point
+    '''
+    polygons = np.asarray(polygons, dtype=float)
+    clip_polygon = np.asarray(clip_polygon, dtype=float)
+    for a, b in zip(clip_polygon, np.roll(clip_polygon, -1, axis=0)):
+        if len(polygons) == 0:
+            break
+        # signed distance to the clip edge line, positive on the inner (left) side
+        normal = np.array([a[1] - b[1], b[0] - a[0]])
+        current, following = polygons, np.roll(polygons, -1, axis=1)
+        d_current, d_following = (current - a) @ normal, (following - a) @ normal
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = d_current / (d_current - d_following)
+        crossing = (d_current >= 0) != (d_following >= 0)
+        intersection = current + np.where(crossing, t, 0)[..., np.newaxis] * (following - current)
+
+        # each edge emits its start if inside, then its crossing with the clip line if any
+        candidates = np.stack((current, intersection), axis=2).reshape(len(polygons), -1, 2)
+        valid = np.stack((d_current >= 0, crossing), axis=2).reshape(len(polygons), -1)
+        counts = valid.sum(axis=1)
+        order = np.argsort(~valid, axis=1, kind='stable')
+        K = max(counts.max(), 1)
+        slots = np.minimum(np.arange(K), np.maximum(counts, 1)[:, np.newaxis] - 1)
+        # move the emitted points to the front in order, padding with the last one
+        polygons = np.take_along_axis(candidates, np.take_along_axis(order, slots, axis=1)[..., np.newaxis], axis=1)
+        # nothing left inside: collapse onto a single point so the area is 0
+        polygons[counts == 0] = polygons[counts == 0][:, :1]
+    return polygons
+
+def calc_polygon_centroids(polygons):
+    '''
+    Returns the (N, 2) area centroids of the padded polygons (shoelace formula) and their (N,) areas,
+    degenerate polygons get the mean of their vertices
+    '''
+    polygons = np.asarray(polygons, dtype=float)
+    # shift to the first vertex so large coordinates do not cancel
+    origin = polygons[:, :1]
+    shifted = polygons - origin
+    following = np.roll(shifted, -1, axis=1)
+    cross = shifted[..., 0]*following[..., 1] - following[..., 0]*shifted[..., 1]
+    areas = cross.sum(axis=1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroids = ((shifted + following) * cross[..., np.newaxis]).sum(axis=1) / (6 * areas[:, np.newaxis])
+    degenerate = np.abs(areas) <= 1e-12 * np.maximum((shifted**2).sum(axis=2).max(axis=1), 1e-300)
+    centroids[degenerate] = shifted[degenerate].mean(axis=1)
+    return centroids + origin[:, 0], np.abs(areas)
+
+def calc_polygon_inertias(polygons, centers):
+    '''
+    Returns the (N,) polar second moments of the padded polygons about their (N, 2) centers,
+    the integral of |x - center|^2 over the polygon, summed over the fan of triangles at the center
+    '''
+    a = np.asarray(polygons, dtype=float) - np.asarray(centers, dtype=float)[:, np.newaxis]
+    b = np.roll(a, -1, axis=1)
+    # signed fan triangle areas times (|a|^2 + |b|^2 + a.b) / 6
+    cross = (a[..., 0]*b[..., 1] - b[..., 0]*a[..., 1]) / 2
+    return np.abs((cross * ((a**2).sum(axis=2) + (b**2).sum(axis=2) + (a*b).sum(axis=2))).sum(axis=1) / 6)
+
+def project_to_convex_polygon(points, polygon):
+    '''
+    Moves the (N, 2) points outside the convex polygon (counterclockwise vertices) to the closest point
+    of its boundary.
+
+    Returns the projected points, the (N,) mask of the points that were outside and (N, 2) unit
+    directions of the edges they were projected onto, 0 for points projected onto a corner
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    polygon = np.asarray(polygon, dtype=float)
+    a, edges = polygon, np.roll(polygon, -1, axis=0) - polygon
+    offsets = points[:, np.newaxis] - a
+    # positive on the inner (left) side of every edge
+    outside = (offsets[..., 0]*edges[:, 1] - offsets[..., 1]*edges[:, 0] > 0).any(axis=1)
+    t = np.clip((offsets * edges).sum(axis=2) / (edges**2).sum(axis=1), 0, 1)
+    closest = a + t[..., np.newaxis] * edges
+    nearest = ((points[:, np.newaxis] - closest)**2).sum(axis=2).argmin(axis=1)
+    rows = np.arange(len(points))
+    projected = np.where(outside[:, np.newaxis], closest[rows, nearest], points)
+    on_edge = (t[rows, nearest] > 0) & (t[rows, nearest] < 1)
+    tangents = np.where(on_edge[:, np.newaxis], edges[nearest] / np.sqrt((edges[nearest]**2).sum(axis=1))[:, np.newaxis], 0)
+    return projected, outside, tangents
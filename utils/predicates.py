@@ -0,0 +1,138 @@
+import numpy as np
+from fractions import Fraction
+
+# Filtered geometric predicates
+#
+# Each predicate first evaluates its determinant in floating point together with
+# a forward error bound (Shewchuk, "Adaptive Precision Floating-Point Arithmetic
+# and Fast Robust Geometric Predicates"). Only when the result is smaller than
+# the bound, i.e. its sign is uncertain, it is recomputed exactly with rationals.
+# The sign of the returned value is always exact.
+
+EPSILON = 2.0 ** -53
+CCW_ERRBOUND = (3.0 + 16.0 * EPSILON) * EPSILON
+ICC_ERRBOUND = (10.0 + 96.0 * EPSILON) * EPSILON
+DOT_ERRBOUND = (3.0 + 16.0 * EPSILON) * EPSILON
+
+def orient2d_exact(pa, pb, pc):
+    ax, ay, bx, by, cx, cy = [Fraction(float(v)) for v in (pa[0], pa[1], pb[0], pb[1], pc[0], pc[1])]
+    return float((ax - cx) * (by - cy) - (ay - cy) * (bx - cx))
+
+def incircle_exact(pa, pb, pc, pd):
+    dx, dy = Fraction(float(pd[0])), Fraction(float(pd[1]))
+    rows = [(Fraction(float(p[0])) - dx, Fraction(float(p[1])) - dy) for p in (pa, pb, pc)]
+    det = 0
+    for i in range(3):
+        ax, ay = rows[i]
+        bx, by = rows[(i+1)%3]
+        cx, cy = rows[(i+2)%3]
+        det += (ax*ax + ay*ay) * (bx*cy - by*cx)
+    return float(det)
+
+def indiametral_exact(pa, pb, pd):
+    ax, ay, bx, by, dx, dy = [Fraction(float(v)) for v in (pa[0], pa[1], pb[0], pb[1], pd[0], pd[1])]
+    return float((ax - dx) * (bx - dx) + (ay - dy) * (by - dy))
+
+def orient2d(pa, pb, pc):
+    '''
+    Returns a positive value if pa, pb, pc are counter-clockwise, negative if clockwise
+    and 0 if collinear (twice the signed triangle area when not near zero)
+    '''
+    detleft = (pa[0] - pc[0]) * (pb[1] - pc[1])
+    detright = (pa[1] - pc[1]) * (pb[0] - pc[0])
+    det = detleft - detright
+    if abs(det) >= CCW_ERRBOUND * (abs(detleft) + abs(detright)):
+        return det
+    return orient2d_exact(pa, pb, pc)
+
+def incircle(pa, pb, pc, pd):
+    '''
+    Returns a positive value if pd lies inside the circle through pa, pb, pc,
+    negative if outside and 0 if cocircular. pa, pb, pc must be counter-clockwise
+    '''
+    adx, ady = pa[0] - pd[0], pa[1] - pd[1]
+    bdx, bdy = pb[0] - pd[0], pb[1] - pd[1]
+    cdx, cdy = pc[0] - pd[0], pc[1] - pd[1]
+
+    bdxcdy, cdxbdy = bdx * cdy, cdx * bdy
+    cdxady, adxcdy = cdx * ady, adx * cdy
+    adxbdy, bdxady = adx * bdy, bdx * ady
+    alift = adx * adx + ady * ady
+    blift = bdx * bdx + bdy * bdy
+    clift = cdx * cdx + cdy * cdy
+
+    det = alift * (bdxcdy - cdxbdy) + blift * (cdxady - adxcdy) + clift * (adxbdy - bdxady)
+    permanent = (abs(bdxcdy) + abs(cdxbdy)) * alift + (abs(cdxady) + abs(adxcdy)) * blift + (abs(adxbdy) + abs(bdxady)) * clift
+    if abs(det) >= ICC_ERRBOUND * permanent:
+        return det
+    return incircle_exact(pa, pb, pc, pd)
+
+def indiametral(pa, pb, pd):
+    '''
+    Returns a negative value if pd lies strictly inside the circle with diameter pa pb
+    (the angle pa pd pb is obtuse), positive if outside and 0 if on the circle
+    '''
+    dotx = (pa[0] - pd[0]) * (pb[0] - pd[0])
+    doty = (pa[1] - pd[1]) * (pb[1] - pd[1])
+    dot = dotx + doty
+    if abs(dot) >= DOT_ERRBOUND * (abs(dotx) + abs(doty)):
+        return dot
+    return indiametral_exact(pa, pb, pd)
+
+def orient2d_batch(triangles):
+    '''
+    triangles: (N, 3, 2) array of triangle points
+
+    Returns orient2d of every triangle as an (N,) array
+    '''
+    triangles = np.asarray(triangles, dtype=float)
+    pa, pb, pc = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    detleft = (pa[:, 0] - pc[:, 0]) * (pb[:, 1] - pc[:, 1])
+    detright = (pa[:, 1] - pc[:, 1]) * (pb[:, 0] - pc[:, 0])
+    det = detleft - detright
+    uncertain = np.flatnonzero(np.abs(det) < CCW_ERRBOUND * (np.abs(detleft) + np.abs(detright)))
+    for i in uncertain:
+        det[i] = orient2d_exact(pa[i], pb[i], pc[i])
+    return det
+
+def incircle_batch(triangles, points):
+    '''
+    triangles: (N, 3, 2) array of counter-clockwise triangle points
+    points: (N, 2) array of query points, or a single point tested against all triangles
+
+    Returns incircle of every triangle and point as an (N,) array
+    '''
+    triangles = np.asarray(triangles, dtype=float)
+    points = np.broadcast_to(np.asarray(points, dtype=float), (len(triangles), 2))
+    d = triangles - points[:, np.newaxis, :]
+    (adx, ady), (bdx, bdy), (cdx, cdy) = d[:, 0].T, d[:, 1].T, d[:, 2].T
+
+    bdxcdy, cdxbdy = bdx * cdy, cdx * bdy
+    cdxady, adxcdy = cdx * ady, adx * cdy
+    adxbdy, bdxady = adx * bdy, bdx * ady
+    alift = adx * adx + ady * ady
+    blift = bdx * bdx + bdy * bdy
+    clift = cdx * cdx + cdy * cdy
+
+    det = alift * (bdxcdy - cdxbdy) + blift * (cdxady - adxcdy) + clift * (adxbdy - bdxady)
+    permanent = (np.abs(bdxcdy) + np.abs(cdxbdy)) * alift + (np.abs(cdxady) + np.abs(adxcdy)) * blift + (np.abs(adxbdy) + np.abs(bdxady)) * clift
+    uncertain = np.flatnonzero(np.abs(det) < ICC_ERRBOUND * permanent)
+    for i in uncertain:
+        det[i] = incircle_exact(*triangles[i], points[i])
+    return det
+
+def indiametral_batch(segments, points):
+    '''
+    segments: (N, 2, 2) array of segment endpoints
+    points: (N, 2) array of query points, or a single point tested against all segments
+
+    Returns indiametral of every segment and point as an (N,) array
+    '''
+    segments = np.asarray(segments, dtype=float)
+    points = np.broadcast_to(np.asarray(points, dtype=float), (len(segments), 2))
+    products = (segments[:, 0] - points) * (segments[:, 1] - points)
+    dot = products[:, 0] + products[:, 1]
+    uncertain = np.flatnonzero(np.abs(dot) < DOT_ERRBOUND * np.abs(products).sum(axis=1))
+    for i in uncertain:
+        dot[i] = indiametral_exact(segments[i, 0], segments[i, 1], points[i])
+    return dot
@@ -0,0 +1,184 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# PLANAR STRAIGHT LINE GRAPH
+# vertices and segments in growable arrays, with hash maps for O(1) segment lookup and splitting
+class PSLG:
+    def __init__(self, V=None, S=None, capacity=16):
+        self.load(V, S, capacity)
+
+    def load(self, V=None, S=None, capacity=16):
+        '''
+        Resets the graph to vertices V and segments S
+        '''
+        self._vertices = np.empty((capacity, 2))
+        self.n_vertices = 0
+        self._segments = np.empty((capacity, 2), dtype=np.int64)
+        self.n_segments = 0
+        # sorted vertex pair -> row of the segment in S
+        self.segment_rows = {}
+        # vertex -> set of sorted vertex pairs of its segments
+        self.incident_segments = []
+        # vertex coordinates -> vertex index
+        self.vertex_rows = {}
+        if V is not None and len(V):
+            self.add_vertices(V)
+        if S is not None:
+            for seg in np.asarray(S, dtype=np.int64).reshape(-1, 2).tolist():
+                self.add_segment(*seg)
+
+    @property
+    def V(self):
+        return self._vertices[:self.n_vertices]
+
+    @property
+    def S(self):
+        return self._segments[:self.n_segments]
+
+    def add_vertex(self, point):
+        return self.add_vertices([point])[0]
+
+    def add_vertices(self, points):
+        '''
+        Appends points, doubling the vertex buffer when full. Returns their indices
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        start, end = self.n_vertices, self.n_vertices + len(points)
+        if end > len(self._vertices):
+            capacity = max(end, 2 * len(self._vertices))
+            self._vertices = np.concatenate((self._vertices[:start], np.empty((capacity - start, 2))))
+        self._vertices[start:end] = points
+        self.n_vertices = end
+        for vert_idx, point in enumerate(points.tolist(), start):
+            self.incident_segments.append(set())
+            self.vertex_rows.setdefault(tuple(point), vert_idx)
+        return range(start, end)
+
+    def add_segment(self, a, b):
+        '''
+        Adds segment (a, b) if not present yet. Returns its row in S,
+        None for a degenerate segment from a vertex to itself, which is ignored
+        '''
+        a, b = int(a), int(b)
+        if a == b:
+            return None
+        key = (min(a, b), max(a, b))
+        if key in self.segment_rows:
+            return self.segment_rows[key]
+        if self.n_segments == len(self._segments):
+            self._segments = np.concatenate((self._segments, np.empty((max(1, len(self._segments)), 2), dtype=np.int64)))
+        row = self.n_segments
+        self._segments[row] = a, b
+        self.n_segments += 1
+        self.segment_rows[key] = row
+        self.incident_segments[a].add(key)
+        self.incident_segments[b].add(key)
+        return row
+
+    def get_segment_row(self, seg):
+        '''
+        Returns the row of segment seg in S (either orientation), None if it is not a segment
+        '''
+        return self.segment_rows.get((min(seg[0], seg[1]), max(seg[0], seg[1])))
+
+    def get_segment(self, a, b):
+        '''
+        Returns segment (a, b) as stored in S, None if it is not a segment
+        '''
+        row = self.segment_rows.get((min(a, b), max(a, b)))
+        return None if row is None else tuple(self._segments[row].tolist())
+
+    def has_segment(self, seg):
+        return self.get_segment_row(seg) is not None
+
+    def get_vertex_index(self, point):
+        return self.vertex_rows.get((float(point[0]), float(point[1])))
+
+    def vertex_segments(self, vert_idx):
+        '''
+        Returns the segments incident to the vertex as stored in S
+        '''
+        return self._segments[sorted(self.segment_rows[key] for key in self.incident_segments[vert_idx])].reshape(-1, 2)
+
+    def split_segment(self, seg, vert_idx):
+        '''
+        Replaces segment seg = (a, b) by (a, vert_idx) and (vert_idx, b).
+        The first half takes the row of seg, the second is appended to S. Returns both halves
+        '''
+        a, b = int(seg[0]), int(seg[1])
+        key = (min(a, b), max(a, b))
+        row = self.segment_rows.pop(key)
+        self.incident_segments[a].discard(key)
+        self.incident_segments[b].discard(key)
+        self._segments[row] = a, vert_idx
+        self.segment_rows[(min(a, vert_idx), max(a, vert_idx))] = row
+        self.incident_segments[a].add((min(a, vert_idx), max(a, vert_idx)))
+        self.incident_segments[vert_idx].add((min(a, vert_idx), max(a, vert_idx)))
+        self.add_segment(vert_idx, b)
+        return [(a, vert_idx), (vert_idx, b)]
+
+    def remove_vertices(self, indices):
+        '''
+        Removes vertices and the segments touching them, renumbering the rest in order.
+        Returns the array mapping old vertex indices to new ones (-1 if removed)
+        '''
+        keep = np.ones(self.n_vertices, dtype=bool)
+        keep[np.asarray(list(indices), dtype=np.int64)] = False
+        new_idx = np.where(keep, np.cumsum(keep) - 1, -1)
+        V, S = self.V[keep], new_idx[self.S]
+        self.load(V, S[(S >= 0).all(axis=1)], capacity=len(self._vertices))
+        return new_idx
+
+    def connected_components(self):
+        '''
+        Returns the component label of every vertex, vertices joined by a chain of segments
+        share a label, vertices without segments are labelled -1
+        '''
+        graph = coo_matrix((np.ones(self.n_segments), (self.S[:, 0], self.S[:, 1])), shape=(self.n_vertices, self.n_vertices))
+        _, labels = connected_components(graph, directed=False)
+        has_segment = np.zeros(self.n_vertices, dtype=bool)
+        has_segment[self.S.ravel()] = True
+        # renumber so labels of vertices with segments are consecutive from 0
+        _, labels[has_segment] = np.unique(labels[has_segment], return_inverse=True)
+        labels[~has_segment] = -1
+        return labels
+
+    def enclosing_segments(self):
+        '''
+        Returns the mask of the segments on the outer boundary of their connected component, with the
+        area the component encloses on one side only. An even-odd point-in-polygon test against them counts
+        the components around a point, slits, internal partitions and dangling polylines do not change it.
+
+        Traces the faces of the planar graph: half-edge u -> v continues with the first outgoing half-edge
+        of v clockwise from v -> u, so bounded faces run counterclockwise and the outer face of every
+        component clockwise (negative area). Outer boundary segments have exactly one side on an outer face
+        '''
+        n = self.n_segments
+        tails, heads = np.concatenate((self.S[:, 0], self.S[:, 1])), np.concatenate((self.S[:, 1], self.S[:, 0]))
+        points = self.V - self.V.mean(axis=0) if n else self.V
+        directions = points[heads] - points[tails]
+        # outgoing half-edges counterclockwise around every vertex, half-edges h and h + n are twins
+        order = np.lexsort((np.arctan2(directions[:, 1], directions[:, 0]), tails))
+        position = np.empty(2 * n, dtype=np.int64)
+        position[order] = np.arange(2 * n)
+        first = np.searchsorted(tails[order], tails, side='left')
+        last = np.searchsorted(tails[order], tails, side='right') - 1
+        twins = np.concatenate((np.arange(n, 2 * n), np.arange(n)))
+        clockwise = np.where(position[twins] > first[twins], position[twins] - 1, last[twins])
+        following = order[clockwise]
+
+        graph = coo_matrix((np.ones(2 * n), (np.arange(2 * n), following)), shape=(2 * n, 2 * n))
+        _, faces = connected_components(graph, directed=False)
+        cross = points[tails, 0] * points[heads, 1] - points[heads, 0] * points[tails, 1]
+        outer = np.bincount(faces, cross, minlength=faces.max(initial=-1) + 1) < 0
+        return outer[faces[:n]] != outer[faces[n:]]
+
+    def copy(self):
+        return PSLG(self.V.copy(), self.S.copy())
+
+    def __len__(self):
+        return self.n_vertices
+
+    def __repr__(self):
+        return f'PSLG({self.n_vertices} vertices, {self.n_segments} segments)'
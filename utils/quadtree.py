@@ -118,6 +118,49 @@ class QuadTree:
         self.points = []
         self.children = []
 
+    def leaves(self):
+        if self.children == []:
+            return [self]
+        return [leaf for child in self.children for leaf in child.leaves()]
+
+    def find_node(self, x, y, min_width):
+        # smallest node containing (x, y) that is not narrower than min_width
+        node = self
+        if not node.boundary.contains_point(Point(x, y)):
+            return None
+        while node.children != [] and node.boundary.w / 2 >= min_width:
+            # children are ordered (left, bottom), (left, top), (right, bottom), (right, top)
+            box = node.boundary
+            node = node.children[2 * (x >= box.x + box.w/2) + (y >= box.y + box.h/2)]
+        return node
+
+    def balance(self):
+        '''
+        Subdivides leaves until leaves sharing a side differ in size by at most a factor of 2
+        '''
+        sides = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+        stack = self.leaves()
+        while stack:
+            leaf = stack.pop()
+            if leaf.children != []:
+                continue
+            box = leaf.boundary
+            center_x, center_y = box.x + box.w/2, box.y + box.h/2
+            for dx, dy in sides:
+                neighbor = self.find_node(center_x + dx*box.w, center_y + dy*box.h, box.w * 0.75)
+                if neighbor is None or neighbor.children == [] or neighbor.boundary.w < box.w * 0.75:
+                    continue
+                # children of the same-size neighbour along the shared side
+                if any(child.children != [] for child in neighbor.children if child.boundary.intersects(box)):
+                    leaf.subdivide()
+                    # the new children and larger leaves next to them may now be unbalanced
+                    stack.extend(leaf.children)
+                    for dx, dy in sides:
+                        neighbor = self.find_node(center_x + dx*box.w, center_y + dy*box.h, box.w)
+                        if neighbor is not None and neighbor.children == []:
+                            stack.append(neighbor)
+                    break
+
     def draw(self, screen):
         self.boundary.draw(screen)
         for child in self.children:
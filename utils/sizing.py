@@ -0,0 +1,97 @@
+import numpy as np
+
+# SIZING FIELDS
+# target edge length h(x, y) for mesh refinement, evaluated on (N, 2) batches of points
+class SizingField:
+    def __init__(self, size, bounds=None, resolution=128, gradation=None):
+        '''
+        size - number, callable mapping (N, 2) points to (N,) target edge lengths,
+               or (ny, nx) grid of target edge lengths at evenly spaced nodes
+        bounds - (x_min, y_min, x_max, y_max) covered by the grid, needed for grids and gradation
+        resolution - grid nodes along the longer side when a callable is sampled for gradation
+        gradation - largest allowed growth of the size per unit distance (e.g. 0.3), the field is
+                    lowered where it grows faster so the mesh has no abrupt size transitions
+        '''
+        self.function = None
+        self.grid = None
+        self.bounds = None if bounds is None else np.asarray(bounds, dtype=float)
+        if np.isscalar(size):
+            self.function = lambda points, h=float(size): np.full(len(points), h)
+        elif callable(size):
+            self.function = size
+        else:
+            self.grid = np.asarray(size, dtype=float)
+            if self.bounds is None:
+                raise ValueError('bounds are required for a gridded sizing field')
+
+        if gradation is not None:
+            if self.grid is None:
+                if self.bounds is None:
+                    raise ValueError('bounds are required to limit the gradation of a sizing function')
+                self.grid = self.sample_grid(resolution)
+                self.function = None
+            self.grid = limit_gradation(self.grid, self.get_spacing(), gradation)
+
+    def get_spacing(self):
+        ny, nx = self.grid.shape
+        x_min, y_min, x_max, y_max = self.bounds
+        return (x_max - x_min) / max(nx - 1, 1), (y_max - y_min) / max(ny - 1, 1)
+
+    def sample_grid(self, resolution):
+        x_min, y_min, x_max, y_max = self.bounds
+        step = max(x_max - x_min, y_max - y_min) / max(resolution - 1, 1)
+        nx, ny = int(np.ceil((x_max - x_min) / step)) + 1, int(np.ceil((y_max - y_min) / step)) + 1
+        x_grid, y_grid = np.meshgrid(np.linspace(x_min, x_max, nx), np.linspace(y_min, y_max, ny))
+        nodes = np.column_stack((x_grid.ravel(), y_grid.ravel()))
+        return np.asarray(self.function(nodes), dtype=float).reshape(ny, nx)
+
+    def __call__(self, points):
+        '''
+        Returns the (N,) target edge lengths at the (N, 2) points
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.grid is None:
+            return np.asarray(self.function(points), dtype=float).reshape(-1)
+        return bilinear_lookup(self.grid, self.bounds, points)
+
+
+def bilinear_lookup(grid, bounds, points):
+    '''
+    Bilinear interpolation of grid values (ny, nx) spanning bounds at the (N, 2) points,
+    points outside the bounds take the value at the nearest border
+    '''
+    ny, nx = grid.shape
+    x_min, y_min, x_max, y_max = bounds
+    # fractional node coordinates
+    u = np.clip((points[:, 0] - x_min) / max(x_max - x_min, 1e-300) * (nx - 1), 0, nx - 1)
+    v = np.clip((points[:, 1] - y_min) / max(y_max - y_min, 1e-300) * (ny - 1), 0, ny - 1)
+    i, j = np.minimum(u.astype(np.int64), max(nx - 2, 0)), np.minimum(v.astype(np.int64), max(ny - 2, 0))
+    i1, j1 = np.minimum(i + 1, nx - 1), np.minimum(j + 1, ny - 1)
+    s, t = u - i, v - j
+    return (grid[j, i] * (1 - s) * (1 - t) + grid[j, i1] * s * (1 - t) +
+            grid[j1, i] * (1 - s) * t + grid[j1, i1] * s * t)
+
+def limit_gradation(grid, spacing, gradation):
+    '''
+    Lowers grid sizes until no size exceeds a neighbouring node's size by more than
+    gradation times their distance (8-neighbour sweeps until nothing changes)
+    '''
+    grid = grid.copy()
+    dx, dy = spacing
+    steps = [(0, 1, dx), (1, 0, dy), (1, 1, np.hypot(dx, dy)), (1, -1, np.hypot(dx, dy))]
+    changed = True
+    while changed:
+        changed = False
+        for di, dj, dist in steps:
+            for sign in (1, -1):
+                shifted = np.full_like(grid, np.inf)
+                rows = slice(max(sign*di, 0), grid.shape[0] + min(sign*di, 0))
+                cols = slice(max(sign*dj, 0), grid.shape[1] + min(sign*dj, 0))
+                src_rows = slice(max(-sign*di, 0), grid.shape[0] + min(-sign*di, 0))
+                src_cols = slice(max(-sign*dj, 0), grid.shape[1] + min(-sign*dj, 0))
+                shifted[rows, cols] = grid[src_rows, src_cols] + gradation * dist
+                lower = shifted < grid
+                if lower.any():
+                    grid[lower] = shifted[lower]
+                    changed = True
+    return grid
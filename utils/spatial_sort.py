@@ -0,0 +1,94 @@
+import numpy as np
+
+# Spatially coherent point orderings for incremental insertion
+
+def quantize(points, bits):
+    '''
+    Returns the points scaled onto an integer grid of 2^bits cells per side
+    '''
+    points = np.asarray(points, dtype=float)
+    min_xy = np.min(points, axis=0)
+    span = max(np.max(np.max(points, axis=0) - min_xy), 1e-300)
+    cells = (points - min_xy) / span * ((1 << bits) - 1)
+    return cells[:, 0].astype(np.int64), cells[:, 1].astype(np.int64)
+
+def morton_index(x, y, bits):
+    '''
+    Returns the Z-order curve index of integer grid coordinates by interleaving their bits
+    '''
+    index = np.zeros(len(x), dtype=np.int64)
+    for bit in range(bits):
+        index |= ((x >> bit) & 1) << (2*bit)
+        index |= ((y >> bit) & 1) << (2*bit + 1)
+    return index
+
+def hilbert_index(x, y, bits):
+    '''
+    Returns the Hilbert curve index of integer grid coordinates
+    '''
+    x, y = x.copy(), y.copy()
+    n = 1 << bits
+    index = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return index
+
+def curve_order(points, curve='hilbert', bits=16):
+    '''
+    Returns the permutation that sorts points along a Hilbert or Morton (Z-order) curve
+    '''
+    if len(points) == 0:
+        return np.arange(0)
+    x, y = quantize(points, bits)
+    if curve == 'hilbert':
+        index = hilbert_index(x, y, bits)
+    elif curve == 'morton':
+        index = morton_index(x, y, bits)
+    else:
+        raise ValueError(f'unknown curve {curve}')
+    return np.argsort(index, kind='stable')
+
+def brio_order(points, curve='hilbert', min_round=64, seed=None):
+    '''
+    Returns a Biased Randomized Insertion Order of the points.
+
+    Every point lands in the last round with probability 1/2, in the round before
+    with probability 1/4 and so on. Rounds are inserted from smallest to largest and
+    each round is sorted along a space-filling curve, which keeps the randomization
+    needed for expected O(n log n) insertion while preserving spatial locality.
+    '''
+    rng = np.random.default_rng(seed)
+    N = len(points)
+    n_rounds = max(int(np.ceil(np.log2(max(N / min_round, 1)))), 0) + 1
+    # geometric round assignment, round n_rounds-1 is the last and largest
+    rounds = n_rounds - 1 - np.minimum(rng.geometric(0.5, size=N) - 1, n_rounds - 1)
+    order = []
+    for r in range(n_rounds):
+        round_idx = np.flatnonzero(rounds == r)
+        order.append(round_idx[curve_order(np.asarray(points)[round_idx], curve)])
+    return np.concatenate(order) if order else np.arange(0)
+
+def insertion_order(points, order=None, seed=None):
+    '''
+    order: None (input order), 'hilbert', 'morton', 'brio' (hilbert sorted rounds) or 'brio-morton'
+
+    Returns the permutation in which points should be inserted
+    '''
+    if order is None or order == 'input' or len(points) < 2:
+        return np.arange(len(points))
+    if order in ('hilbert', 'morton'):
+        return curve_order(points, order)
+    if order in ('brio', 'brio-hilbert'):
+        return brio_order(points, 'hilbert', seed=seed)
+    if order == 'brio-morton':
+        return brio_order(points, 'morton', seed=seed)
+    raise ValueError(f'unknown insertion order {order}')